@@ -22,6 +22,11 @@ c.PortalSpawner.network_name = 'repo'
 c.PortalSpawner.remove_containers = True
 c.PortalSpawner.debug = True
 
+# Keep idle, already started containers for each whitelisted image (0 disables)
+# Claiming one bind mounts the user's directory into it, which requires the hub
+# to run with mount privileges and DATA_DIR to be a shared (rshared) mount
+c.PortalSpawner.warm_pool_size = 0
+
 
 # Services API configuration
 c.JupyterHub.services = [
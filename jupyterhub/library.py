@@ -1,25 +1,108 @@
-from zipfile import ZipFile
+from concurrent.futures import ThreadPoolExecutor
 
 import tornado.ioloop
 import tornado.web
-import shutil
+import time
+import uuid
 import os
 
+from repository import BlobStore
 
-class ZipHandler(tornado.web.RequestHandler):
-    def post(self):
-        id = self.get_argument("id"),
-        username = self.get_argument("user", strip=True),
-        servername = self.get_argument("server", strip=True),
-        zip = f'/data/repository/{id[0]}'
-        shutil.make_archive(zip, 'zip', f'/data/users/{username[0]}/{servername[0]}')
-        os.chmod(f'{zip}.zip', 0o777)
+# Archive work runs on a bounded pool so that the IOLoop stays responsive
+MAX_WORKERS = 4        # Archives being written or extracted at the same time
+MAX_PENDING = 64       # Queued and running jobs before new requests are turned away
+JOB_RETENTION = 3600   # Seconds a finished job remains visible on the status endpoint
+EXPORT_RETRY = 60     # Seconds a failed export is reported to downloads before it is tried again
+GC_INTERVAL = 86400    # Seconds between sweeps for blobs no publication refers to any more
+LINK_MODE = 'auto'     # How copies are cloned from the blob store: auto, reflink, hardlink or copy
 
-    def get(self):
-        copy = self.get_argument("copy", strip=True),
-        username = self.get_argument("user", strip=True)[0],
-        servername = self.get_argument("server", strip=True)[0],
-        ZipHandler._copy_notebook_project(copy[0], username, servername)
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+jobs = {}
+store = BlobStore('/data/repository', link_mode=LINK_MODE)
+
+
+class Job:
+    def __init__(self, kind, target):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.target = target
+        self.state = 'queued'
+        self.error = None
+        self.result = None
+        self.created = time.time()
+        self.finished = None
+        self.future = None
+
+    def run(self, func, *args):
+        self.state = 'running'
+        try:
+            self.result = func(*args)
+            self.state = 'done'
+        except Exception as e:
+            self.state = 'failed'
+            self.error = str(e)
+        finally:
+            self.finished = time.time()
+
+    def to_json(self):
+        return {'id': self.id, 'kind': self.kind, 'target': self.target, 'state': self.state, 'error': self.error,
+                'result': self.result, 'created': self.created, 'finished': self.finished}
+
+
+def submit_job(kind, target, func, *args):
+    """
+    Queue archive work on the executor, returning the Job and the future that resolves when it is finished
+    """
+    now = time.time()
+    for id in [id for id, job in jobs.items() if job.finished and now - job.finished > JOB_RETENTION]:
+        del jobs[id]
+    if sum(1 for job in jobs.values() if not job.finished) >= MAX_PENDING:
+        raise tornado.web.HTTPError(503, 'Too many archive jobs in progress, try again later')
+
+    job = Job(kind, target)
+    jobs[job.id] = job
+    job.future = tornado.ioloop.IOLoop.current().run_in_executor(executor, job.run, func, *args)
+    return job, job.future
+
+
+def find_job(kind, target):
+    """
+    Return the latest job of this kind for this target, or None
+    """
+    found = [job for job in jobs.values() if job.kind == kind and job.target == target]
+    return max(found, key=lambda job: job.created) if found else None
+
+
+class JobRequestHandler(tornado.web.RequestHandler):
+    async def _respond(self, job, future):
+        # Callers that pass wait=false get the job back immediately and poll its status
+        if self.get_argument('wait', 'true').lower() == 'false':
+            self.set_status(202)
+            self.set_header('Location', f'/services/library/jobs/{job.id}')
+        else:
+            await future
+            if job.state == 'failed': self.set_status(500)
+        self.write(job.to_json())
+
+
+class ZipHandler(JobRequestHandler):
+    async def post(self):
+        id = self.get_argument("id")
+        username = self.get_argument("user", strip=True)
+        servername = self.get_argument("server", strip=True)
+        job, future = submit_job('publish', id, ZipHandler._publish_notebook_project, id, username, servername)
+        await self._respond(job, future)
+
+    async def get(self):
+        copy = self.get_argument("copy", strip=True)
+        username = self.get_argument("user", strip=True)
+        servername = self.get_argument("server", strip=True)
+        job, future = submit_job('copy', copy, ZipHandler._copy_notebook_project, copy, username, servername)
+        await self._respond(job, future)
+
+    @staticmethod
+    def _publish_notebook_project(id, username, servername):
+        store.publish(id, f'/data/users/{username}/{servername}')
 
     @staticmethod
     def _copy_notebook_project(project_copy, mount_username, server_name):
@@ -30,17 +113,56 @@ class ZipHandler(tornado.web.RequestHandler):
             os.makedirs(dir_path)
             os.chmod(dir_path, 0o777)
 
-        with ZipFile(f'/data/repository/{project_copy}.zip', 'r') as zip:
-            zip.extractall(path=dir_path)
+        store.materialize(project_copy, dir_path)
+
+
+class ExportHandler(JobRequestHandler):
+    async def get(self):
+        id = self.get_argument("id")
+        if not store.exists(id): raise tornado.web.HTTPError(404)
+
+        # Downloads ask again until the archive exists, so answer at once if it does and never export it twice
+        if store.current_archive(id):
+            job = Job('export', id)
+            job.run(ExportHandler._export_notebook_project, id)
+            self.write(job.to_json())
+            return
+        job = find_job('export', id)
+        if job and (not job.finished or (job.state == 'failed' and time.time() - job.finished < EXPORT_RETRY)):
+            future = job.future
+        else:
+            job, future = submit_job('export', id, ExportHandler._export_notebook_project, id)
+        await self._respond(job, future)
+
+    @staticmethod
+    def _export_notebook_project(id):
+        # Return the archive's path relative to the repository, which is mounted elsewhere on the portal
+        return os.path.relpath(store.export(id), store.root)
+
+
+class JobHandler(tornado.web.RequestHandler):
+    def get(self, id):
+        if id not in jobs: raise tornado.web.HTTPError(404)
+        self.write(jobs[id].to_json())
 
 
 def make_app():
     return tornado.web.Application([
         (r"/services/library/", ZipHandler),
+        (r"/services/library/export/", ExportHandler),
+        (r"/services/library/jobs/([0-9a-f]+)", JobHandler),
     ])
 
 
+def collect_garbage():
+    try:
+        submit_job('gc', 'blobs', store.collect_garbage)
+    except tornado.web.HTTPError:
+        pass  # Busy, try again at the next interval
+
+
 if __name__ == "__main__":
     app = make_app()
     app.listen(8011)
+    tornado.ioloop.PeriodicCallback(collect_garbage, GC_INTERVAL * 1000).start()
     tornado.ioloop.IOLoop.current().start()
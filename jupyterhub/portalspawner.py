@@ -1,10 +1,68 @@
 import os
-import shutil
-from zipfile import ZipFile
+import subprocess
+import time
+import uuid
+
+from docker.errors import APIError
 from dockerspawner import DockerSpawner
+from prometheus_client import Counter, Gauge
+from tornado import gen
+from tornado.ioloop import IOLoop
+from traitlets import Integer, List, Unicode, default
+
+from repository import BlobStore
+
+POOL_HITS = Counter('portal_warm_pool_hits_total', 'Launches served by a pre-warmed container', ['image'])
+POOL_MISSES = Counter('portal_warm_pool_misses_total', 'Launches that had to cold-start a container', ['image'])
+POOL_IDLE = Gauge('portal_warm_pool_idle', 'Idle pre-warmed containers', ['image'])
+
+POOL_LABEL = 'org.genepattern.warm-pool'
+DEFAULTS_ID = '.defaults'  # Publication holding the snapshot of the files seeded into every new project
 
 
 class PortalSpawner(DockerSpawner):
+    warm_pool_size = Integer(0, config=True, help="""
+        Number of idle, already started containers to keep for each whitelisted image. 0 disables the pool.
+
+        A launch claims an idle container: the user's directory is bind mounted over the container's pool slot,
+        which must propagate into the container (the hub needs mount privileges and DATA_DIR must be a shared
+        mount), the container is renamed and the single-user server is exec'd inside it.
+        """)
+
+    warm_pool_dir = Unicode(config=True, help="Host directory holding the mount slots of pooled containers")
+
+    warm_pool_idle_cmd = List(['tail', '-f', '/dev/null'], config=True,
+                              help="Command keeping an unclaimed pooled container alive")
+
+    warm_pool_bind_cmd = List(['mount', '--bind'], config=True,
+                              help="Command run by the hub as <cmd> <user directory> <slot> when claiming")
+
+    warm_pool_unbind_cmd = List(['umount', '--lazy'], config=True,
+                                help="Command run by the hub as <cmd> <slot> when a pooled server stops")
+
+    link_mode = Unicode('auto', config=True, help="""
+        How copies of published projects are cloned from the repository's blob store: 'auto' (reflink where the
+        filesystem supports it, otherwise copy), 'reflink', 'hardlink' (read-only links, notebooks are copied)
+        or 'copy'
+        """)
+
+    defaults_refresh_interval = Integer(60, config=True,
+                                        help="Seconds between checks of DATA_DIR/defaults for changed default files")
+
+    pool_slot = Unicode('')  # Slot directory of the claimed pooled container, if any
+    pool_exec_id = Unicode('')  # Exec instance running the single-user server in the claimed container
+
+    _defaults_checked = None  # When the defaults snapshot was last compared with DATA_DIR/defaults
+    _defaults_version = None
+
+    _pool = {}  # image -> list of (container id, slot) waiting to be claimed, shared by all spawners
+    _pool_filling = set()
+    _pool_started = False
+
+    @default('warm_pool_dir')
+    def _default_warm_pool_dir(self):
+        return os.environ['DATA_DIR'] + '/pool'
+
     def __init__(self, **kwargs):
         self.remove_containers = True
         self.debug = True
@@ -13,6 +71,11 @@ class PortalSpawner(DockerSpawner):
         }
         super(PortalSpawner, self).__init__(**kwargs)
 
+        # Warm up every whitelisted image the first time a spawner is created
+        if self.warm_pool_size and not PortalSpawner._pool_started:
+            PortalSpawner._pool_started = True
+            IOLoop.current().spawn_callback(self._start_pool)
+
     def run_pre_spawn_hook(self):
         project_copy = getattr(self, "project_copy", "")
         mount_username = getattr(self, "mount_username", self.user.name)
@@ -41,8 +104,159 @@ class PortalSpawner(DockerSpawner):
             "mount_username": mount_username
         }
 
-    @staticmethod
-    def _copy_notebook_project(project_copy, mount_username, server_name):
+    def load_state(self, state):
+        super(PortalSpawner, self).load_state(state)
+        self.pool_slot = state.get('pool_slot', '')
+        self.pool_exec_id = state.get('pool_exec_id', '')
+
+    def get_state(self):
+        state = super(PortalSpawner, self).get_state()
+        if self.pool_slot:
+            state['pool_slot'] = self.pool_slot
+            state['pool_exec_id'] = self.pool_exec_id
+        return state
+
+    def clear_state(self):
+        super(PortalSpawner, self).clear_state()
+        self.pool_slot = ''
+        self.pool_exec_id = ''
+
+    @gen.coroutine
+    def start(self, image=None, extra_create_kwargs=None, extra_host_config=None):
+        if not self.warm_pool_size:
+            return (yield super(PortalSpawner, self).start(image, extra_create_kwargs, extra_host_config))
+
+        # Resolve the image the same way DockerSpawner does, so the right pool is used
+        image_option = self.user_options.get('image')
+        if image_option: self.image = yield self.check_image_whitelist(image_option)
+        pooled = self._claim(self.image)
+
+        try:
+            if pooled is None:
+                POOL_MISSES.labels(self.image).inc()
+                return (yield super(PortalSpawner, self).start(image, extra_create_kwargs, extra_host_config))
+            else:
+                POOL_HITS.labels(self.image).inc()
+                return (yield self._start_pooled(*pooled))
+        finally:
+            IOLoop.current().spawn_callback(self._fill_pool, self.image)
+
+    @gen.coroutine
+    def poll(self):
+        status = yield super(PortalSpawner, self).poll()
+        if status is not None or not self.pool_exec_id: return status
+
+        # A pooled container outlives its single-user server, so check the exec'd process too
+        try:
+            process = yield self.docker('exec_inspect', self.pool_exec_id)
+        except APIError:
+            return 0
+        if process['Running']: return None
+        else: return f"ExitCode={process['ExitCode']}"
+
+    @gen.coroutine
+    def stop(self, now=False):
+        slot = self.pool_slot
+        yield super(PortalSpawner, self).stop(now=now)
+        if slot: yield self.executor.submit(self._release_slot, slot)
+
+    def _release_slot(self, slot):
+        subprocess.call(self.warm_pool_unbind_cmd + [slot])
+        try:
+            os.rmdir(slot)  # Never rmtree: if the unmount failed the slot still shows the user's files
+        except OSError:
+            self.log.warning("Could not remove pool slot %s", slot)
+
+    @gen.coroutine
+    def _start_pool(self):
+        # Remove pooled containers left unclaimed by a previous run of the hub
+        leftovers = yield self.docker('containers', all=True, filters={'label': POOL_LABEL})
+        for container in leftovers:
+            if any(name.startswith(f'/{self.prefix}-pool-') for name in container['Names']):
+                yield self.docker('remove_container', container['Id'], force=True)
+
+        for image in set(self._get_image_whitelist().values()) or {self.image}:
+            IOLoop.current().spawn_callback(self._fill_pool, image)
+
+    @gen.coroutine
+    def _fill_pool(self, image):
+        if image in PortalSpawner._pool_filling: return
+        PortalSpawner._pool_filling.add(image)
+        idle = PortalSpawner._pool.setdefault(image, [])
+        try:
+            while len(idle) < self.warm_pool_size:
+                idle.append((yield self._create_pooled(image)))
+                POOL_IDLE.labels(image).set(len(idle))
+        except Exception:
+            self.log.exception("Failed to warm a container for %s", image)
+        finally:
+            PortalSpawner._pool_filling.discard(image)
+
+    @gen.coroutine
+    def _create_pooled(self, image):
+        """
+        Create and start an idle container whose home directory is an empty slot that a user directory is later
+        bind mounted over
+        """
+        yield self.pull_image(image)
+
+        token = uuid.uuid4().hex[:12]
+        slot = os.path.join(self.warm_pool_dir, token)
+        os.makedirs(slot)
+        os.chmod(slot, 0o777)
+
+        host_config = dict(binds={slot: {'bind': '/home/jovyan', 'mode': 'rw,rslave'}}, links=self.links)
+        if getattr(self, 'mem_limit', None) is not None: host_config['mem_limit'] = self.mem_limit
+        if not self.use_internal_ip: host_config['port_bindings'] = {self.port: (self.host_ip,)}
+        host_config.update(self.extra_host_config)
+        host_config.setdefault('network_mode', self.network_name)
+
+        container = yield self.docker('create_container', image=image, command=self.warm_pool_idle_cmd,
+                                      name=f'{self.prefix}-pool-{token}', volumes=['/home/jovyan'],
+                                      ports={f'{self.port}/tcp': None}, labels={POOL_LABEL: image},
+                                      host_config=self.client.create_host_config(**host_config))
+        yield self.docker('start', container['Id'])
+        return container['Id'], slot
+
+    def _claim(self, image):
+        idle = PortalSpawner._pool.get(image)
+        if not idle: return None
+        pooled = idle.pop()
+        POOL_IDLE.labels(image).set(len(idle))
+        return pooled
+
+    @gen.coroutine
+    def _start_pooled(self, container_id, slot):
+        """
+        Hand a pooled container to this user: mount their directory, rename it and exec the single-user server
+        """
+        user_dir = next(host for host, bind in self.volume_binds.items() if bind['bind'] == '/home/jovyan')
+        try:
+            yield self.executor.submit(subprocess.check_call, self.warm_pool_bind_cmd + [user_dir, slot])
+            self.pool_slot = slot
+
+            obj = yield self.get_object()
+            if obj: yield self.remove_object()  # A container that should have been cleaned up
+
+            yield self.docker('rename', container_id, self.container_name)
+            self.object_id = container_id
+
+            command = yield self.get_command()
+            process = yield self.docker('exec_create', container_id, command, environment=self.get_env())
+            yield self.docker('exec_start', process['Id'], detach=True)
+            self.pool_exec_id = process['Id']
+        except Exception:
+            # Do not leave a half-claimed container behind with the user's directory mounted in it
+            yield self.docker('remove_container', container_id, force=True)
+            if self.pool_slot: yield self.executor.submit(self._release_slot, slot)
+            self.clear_state()
+            raise
+
+        self.log.info("Claimed pooled container %s for %s from image %s", container_id[:7], self.container_name,
+                      self.image)
+        return (yield self.get_ip_and_port())
+
+    def _copy_notebook_project(self, project_copy, mount_username, server_name):
         dir_path = os.environ['DATA_DIR'] + '/users/' + mount_username + '/' + server_name
 
         # Create directory if it doesn't exist
@@ -50,12 +264,11 @@ class PortalSpawner(DockerSpawner):
             os.makedirs(dir_path)
             os.chmod(dir_path, 0o777)
 
-        with ZipFile(project_copy, 'r') as zip:
-            zip.extractall(path=dir_path)
+        # project_copy is the path of the publication's legacy zip, the store imports it if there is no manifest
+        repository_dir, file_name = os.path.split(project_copy)
+        BlobStore(repository_dir, link_mode=self.link_mode).materialize(os.path.splitext(file_name)[0], dir_path)
 
-    @staticmethod
-    def _create_directory(username, servername):
-        default_nb_dir = os.environ['DATA_DIR'] + '/defaults'
+    def _create_directory(self, username, servername):
         dir_path = os.environ['DATA_DIR'] + '/users/' + username + '/' + servername
 
         # Create directory if it doesn't exist
@@ -63,12 +276,21 @@ class PortalSpawner(DockerSpawner):
             os.makedirs(dir_path)
             os.chmod(dir_path, 0o777)
 
-            # Copy default files over if the directory was just created
-            all_files = os.listdir(default_nb_dir)
-            for f in all_files:
-                file_path = os.path.join(default_nb_dir, f)
-                if not os.path.exists(file_path):
-                    if os.path.isdir(file_path):
-                        shutil.copytree(file_path, os.path.join(dir_path, f))
-                    elif os.path.isfile(file_path):
-                        shutil.copy(file_path, dir_path)
\ No newline at end of file
+            # Seed the default files if the directory was just created
+            self._defaults_snapshot().materialize(DEFAULTS_ID, dir_path)
+
+    def _defaults_snapshot(self):
+        """
+        Return the blob store holding the snapshot of DATA_DIR/defaults, refreshing the snapshot if it has not been
+        checked for defaults_refresh_interval seconds. Unchanged files are only stat'ed by the refresh.
+        """
+        store = BlobStore(os.environ['DATA_DIR'] + '/repository', link_mode=self.link_mode)
+        now = time.monotonic()
+        if PortalSpawner._defaults_checked is None or now - PortalSpawner._defaults_checked > \
+                self.defaults_refresh_interval or not os.path.exists(store.manifest_path(DEFAULTS_ID)):
+            manifest = store.publish(DEFAULTS_ID, os.environ['DATA_DIR'] + '/defaults')
+            if manifest['version'] != PortalSpawner._defaults_version:
+                self.log.info("Default project files are at version %s", manifest['version'][:12])
+                PortalSpawner._defaults_version = manifest['version']
+            PortalSpawner._defaults_checked = now
+        return store
@@ -0,0 +1,279 @@
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+
+REPOSITORY_DIR = '/data/repository'
+CHUNK_SIZE = 1024 * 1024
+
+FICLONE = 0x40049409  # Linux ioctl sharing the extents of one file with another (btrfs, XFS, ...)
+LINK_MODES = ('auto', 'reflink', 'hardlink', 'copy')
+COPIED_SUFFIXES = ('.ipynb',)  # Saved in place by Jupyter, so never hardlinked to a shared blob
+ARCHIVE_NAME = re.compile(r'.+-[0-9a-f]{16}\.zip')  # <publication id>-<version>.zip
+
+
+class BlobStore:
+    """
+    Content-addressed store for published notebook projects
+
+    Every file is stored once under blobs/<first two hex digits>/<sha256>, however many publications contain it.
+    Each publication is a manifest under manifests/<id>.json listing the path, digest, size and mode of its files
+    and a version derived from them, so republishing only writes the files that changed and copying reads the blobs a manifest points to.
+    Publications from before the store existed are imported from <id>.zip the first time they are copied.
+
+    link_mode decides how a copy gets its files from the read-only blobs:
+      auto      reflink (copy-on-write clone) where the filesystem supports it, otherwise copy
+      reflink   same as auto
+      hardlink  hardlink every file except notebooks, which are copied. Linked files are read-only: a program that
+                replaces the file (as Jupyter does when saving) works, one that writes into it gets a permission error
+      copy      always copy the bytes
+    """
+
+    def __init__(self, root=REPOSITORY_DIR, link_mode='auto'):
+        if link_mode not in LINK_MODES: raise ValueError(f'Unknown link mode: {link_mode}')
+        self.root = root
+        self.link_mode = link_mode
+        self.blob_dir = os.path.join(root, 'blobs')
+        self.manifest_dir = os.path.join(root, 'manifests')
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def manifest_path(self, id):
+        return os.path.join(self.manifest_dir, f'{id}.json')
+
+    def zip_path(self, id):
+        return os.path.join(self.root, f'{id}.zip')
+
+    def exists(self, id):
+        return os.path.exists(self.manifest_path(id)) or os.path.exists(self.zip_path(id))
+
+    def load_manifest(self, id):
+        with open(self.manifest_path(id)) as f:
+            return json.load(f)
+
+    def publish(self, id, source_dir):
+        """
+        Store the contents of source_dir as publication id, hashing every file but writing only unseen content
+        :return: the manifest
+        """
+        # A missing directory would otherwise replace the publication with an empty one
+        if not os.path.isdir(source_dir): raise NotADirectoryError(f'Not a project directory: {source_dir}')
+
+        # Files whose size and mtime match the previous publication keep their digest without being read again
+        previous, previous_manifest = {}, None
+        if os.path.exists(self.manifest_path(id)):
+            previous_manifest = self.load_manifest(id)
+            previous = {f['path']: dict(f) for f in previous_manifest['files']}
+
+        dirs, files = [], []
+        for root, dir_names, file_names in os.walk(source_dir):
+            dir_names.sort()
+            for name in dir_names:
+                dirs.append(os.path.relpath(os.path.join(root, name), source_dir))
+            for name in sorted(file_names):
+                path = os.path.join(root, name)
+                if os.path.islink(path) or not os.path.isfile(path): continue
+                stat = os.stat(path)
+                relpath = os.path.relpath(path, source_dir)
+
+                entry = previous.get(relpath)
+                if entry is None or entry['size'] != stat.st_size or entry.get('mtime') != stat.st_mtime_ns or \
+                        not self.touch(entry['sha256']):
+                    entry = {'path': relpath, 'sha256': self.add_file(path), 'size': stat.st_size}
+                entry['mode'] = stat.st_mode & 0o777
+                entry['mtime'] = stat.st_mtime_ns
+                files.append(entry)
+
+        # The version identifies the content, so an unchanged republish does not rewrite the manifest
+        version = hashlib.sha256(json.dumps([dirs, [(f['path'], f['sha256'], f['mode']) for f in files]])
+                                 .encode()).hexdigest()
+        if previous_manifest is not None and previous_manifest.get('version') == version and \
+                [f.get('mtime') for f in previous_manifest['files']] == [f['mtime'] for f in files]:
+            return previous_manifest
+
+        manifest = {'id': id, 'version': version, 'created': time.time(), 'dirs': dirs, 'files': files}
+        self._write_atomic(self.manifest_path(id), json.dumps(manifest).encode())
+        return manifest
+
+    def add_file(self, path):
+        """
+        Add a file to the store, copying it only if its content is not already there
+        :return: the file's sha256 digest
+        """
+        digest = hash_file(path)
+        blob = self.blob_path(digest)
+        if not self.touch(digest):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            tmp_path = f'{blob}.{uuid.uuid4().hex}.tmp'
+            shutil.copyfile(path, tmp_path)
+            os.chmod(tmp_path, 0o444)  # Blobs are shared by every publication, never modify them in place
+            os.replace(tmp_path, blob)
+        return digest
+
+    def touch(self, digest):
+        """
+        Restart the grace period of a blob a publish reuses, so that collect_garbage cannot delete it before the
+        manifest referring to it is written
+        :return: whether the blob exists
+        """
+        try:
+            os.utime(self.blob_path(digest))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def materialize(self, id, target_dir):
+        """
+        Write the files of publication id into target_dir, cloning them from the blobs according to link_mode
+        :return: dict counting the files written by each method
+        """
+        if not os.path.exists(self.manifest_path(id)): self.import_zip(id)
+
+        manifest = self.load_manifest(id)
+        for relpath in manifest['dirs']:
+            os.makedirs(safe_join(target_dir, relpath), exist_ok=True)
+
+        counts = {'reflink': 0, 'hardlink': 0, 'copy': 0}
+        mode = self.link_mode
+        for entry in manifest['files']:
+            path = safe_join(target_dir, entry['path'])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.lexists(path): os.remove(path)  # Never write through an existing link into a blob
+
+            method = clone_file(self.blob_path(entry['sha256']), path,
+                                'copy' if mode == 'hardlink' and path.endswith(COPIED_SUFFIXES) else mode)
+            if method != 'hardlink': os.chmod(path, entry['mode'] | 0o600)  # A hardlink shares the blob's mode
+            if method == 'copy' and mode in ('auto', 'reflink'): mode = 'copy'  # Reflinks unsupported, stop trying
+            counts[method] += 1
+        return counts
+
+    def archive_path(self, id, version):
+        return os.path.join(self.root, 'archives', f'{id}-{version[:16]}.zip')
+
+    def current_archive(self, id):
+        """
+        :return: path of the archive of the current version of publication id, or None if it was not exported yet
+        """
+        if not os.path.exists(self.manifest_path(id)): return None
+        path = self.archive_path(id, self.load_manifest(id)['version'])
+        return path if os.path.exists(path) else None
+
+    def export(self, id):
+        """
+        Write the current version of publication id to a zip archive for download, unless it already exists.
+        Archives of previous versions are removed.
+        :return: path of the archive
+        """
+        if not os.path.exists(self.manifest_path(id)): self.import_zip(id)
+
+        manifest = self.load_manifest(id)
+        path = self.archive_path(id, manifest['version'])
+        if os.path.exists(path): return path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with ZipFile(tmp_path, 'w', ZIP_DEFLATED) as zip:
+            for relpath in manifest['dirs']:
+                zip.writestr(relpath + '/', b'')
+            for entry in manifest['files']:
+                # Record the mode and time of the published file rather than those of the read-only blob
+                info = ZipInfo(entry['path'], time.localtime(max(entry['mtime'] / 1e9, 315532800))[:6])
+                info.external_attr = (0o100000 | entry['mode']) << 16
+                info.compress_type = ZIP_DEFLATED
+                with open(self.blob_path(entry['sha256']), 'rb') as src, zip.open(info, 'w') as dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+
+        for name in os.listdir(os.path.dirname(path)):
+            if ARCHIVE_NAME.fullmatch(name) and name.rsplit('-', 1)[0] == id and name != os.path.basename(path):
+                os.remove(os.path.join(os.path.dirname(path), name))
+        return path
+
+    def import_zip(self, id):
+        """
+        Move a publication from its legacy zip archive into the store, unpacking it once
+        """
+        with tempfile.TemporaryDirectory(dir=self.root) as tmp_dir:
+            with ZipFile(self.zip_path(id), 'r') as zip:
+                zip.extractall(path=tmp_dir)
+            self.publish(id, tmp_dir)
+
+    def collect_garbage(self, grace=3600):
+        """
+        Delete blobs that no manifest refers to. Blobs younger than grace seconds are kept, as a publish may be
+        storing them before writing its manifest.
+        :return: number of blobs deleted
+        """
+        referenced = set()
+        for name in os.listdir(self.manifest_dir) if os.path.exists(self.manifest_dir) else []:
+            if name.endswith('.json'):
+                referenced.update(f['sha256'] for f in self.load_manifest(name[:-len('.json')])['files'])
+
+        deleted = 0
+        cutoff = time.time() - grace
+        for root, dir_names, file_names in os.walk(self.blob_dir):
+            for name in file_names:
+                path = os.path.join(root, name)
+                if name not in referenced and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    deleted += 1
+        return deleted
+
+    @staticmethod
+    def _write_atomic(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+
+
+def hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def clone_file(src, dst, mode):
+    """
+    Create dst with the content of src as cheaply as mode allows, falling back to a copy
+    :return: the method that was used, 'reflink', 'hardlink' or 'copy'
+    """
+    if mode in ('auto', 'reflink'):
+        try:
+            with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            return 'reflink'
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV, errno.ENOSYS): raise
+    elif mode == 'hardlink':
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK): raise
+
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+
+def safe_join(root, relpath):
+    """
+    Join a manifest path to root, refusing paths that would escape it
+    """
+    path = os.path.normpath(os.path.join(root, relpath))
+    if os.path.commonpath([path, os.path.normpath(root)]) != os.path.normpath(root):
+        raise ValueError(f'Path escapes the project directory: {relpath}')
+    return path
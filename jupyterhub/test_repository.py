@@ -0,0 +1,72 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from repository import BlobStore
+
+
+class CollectGarbageTests(unittest.TestCase):
+    """
+    Run with: python -m unittest test_repository (from this directory)
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = BlobStore(os.path.join(self.tmp.name, 'repository'))
+        self.source = os.path.join(self.tmp.name, 'source')
+        os.makedirs(self.source)
+        self.write('notebook.ipynb', b'{"cells": []}')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, content):
+        with open(os.path.join(self.source, name), 'wb') as f:
+            f.write(content)
+
+    def age(self, digest, seconds=7200):
+        old = time.time() - seconds
+        os.utime(self.store.blob_path(digest), (old, old))
+
+    def test_unreferenced_old_blobs_are_deleted(self):
+        digest = self.store.add_file(os.path.join(self.source, 'notebook.ipynb'))
+        self.age(digest)
+        self.assertEqual(self.store.collect_garbage(), 1)
+        self.assertFalse(os.path.exists(self.store.blob_path(digest)))
+
+    def test_reused_old_blob_survives_collection_before_manifest(self):
+        # Another publication stored the same content long ago and has since been unpublished
+        digest = self.store.add_file(os.path.join(self.source, 'notebook.ipynb'))
+        self.age(digest)
+
+        # Collect garbage after the publish stored its files but before it wrote the manifest
+        write_manifest = BlobStore._write_atomic
+        def collect_then_write(path, data):
+            self.store.collect_garbage()
+            write_manifest(path, data)
+        with mock.patch.object(BlobStore, '_write_atomic', side_effect=collect_then_write):
+            manifest = self.store.publish('user-project', self.source)
+
+        self.assertEqual(manifest['files'][0]['sha256'], digest)
+        self.assertTrue(os.path.exists(self.store.blob_path(digest)))
+
+    def test_republish_restarts_grace_of_reused_entries(self):
+        self.store.publish('user-project', self.source)
+        digest = self.store.load_manifest('user-project')['files'][0]['sha256']
+        self.age(digest)
+
+        self.write('data.csv', b'a,b\n')  # The notebook's entry is reused without hashing it again
+        self.store.publish('user-project', self.source)
+        self.assertGreater(os.path.getmtime(self.store.blob_path(digest)), time.time() - 60)
+
+    def test_publish_from_missing_directory_keeps_manifest(self):
+        manifest = self.store.publish('user-project', self.source)
+        with self.assertRaises(NotADirectoryError):
+            self.store.publish('user-project', os.path.join(self.tmp.name, 'missing'))
+        self.assertEqual(self.store.load_manifest('user-project'), manifest)
+
+
+if __name__ == '__main__':
+    unittest.main()
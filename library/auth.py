@@ -1,20 +1,46 @@
 import json
+import re
+import time
 import requests
 from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth.models import User
+from django.core import signing
+from django.core.cache import cache
+from django.utils.crypto import salted_hmac
 from rest_framework import authentication
 from rest_framework import exceptions
+from rest_framework import permissions
 
 from library import settings
 
+FAILED = 'failed'  # Cached in place of a token for rejected credentials
+UNAVAILABLE = 'unavailable'  # Cached in place of a token when GenePattern did not answer in time
+
+TOKEN_SALT = 'library.auth.SignedTokenAuthentication'
+TOKEN_SCOPES = ('read', 'write')  # read allows safe methods (GET, HEAD, OPTIONS), write allows the others
+# What signing.dumps writes: [.]<base64 payload>:<base62 timestamp>:<signature>
+TOKEN_FORMAT = re.compile(r'\.?[\w-]+:[0-9A-Za-z]+:[\w-]+', re.ASCII)
+
 
 def connect_to_genepattern(username, password):
     """
-    Call the GenePattern server to verify credentials
+    Verify credentials with the GenePattern server, reusing the outcome of a recent verification of the same
+    credentials: successes for GENEPATTERN_AUTH_TTL seconds, rejections and requests that took longer than
+    GENEPATTERN_AUTH_TIMEOUT seconds for GENEPATTERN_AUTH_FAILURE_TTL seconds
     :param username:
     :param password:
-    :return:
+    :return: (user, access token)
     """
+    key = credentials_key(username, password)
+    cached = cache.get(key)
+    if cached == FAILED:
+        raise exceptions.AuthenticationFailed('Invalid username or password')
+    if cached == UNAVAILABLE:
+        raise exceptions.AuthenticationFailed('Unable to verify credentials with GenePattern')
+    if cached is not None:
+        user = User.objects.filter(pk=cached['user']).first()
+        if user is not None and user.is_active: return (user, cached['token'])
+
     # Set the necessary params
     params = dict(
         grant_type="password",
@@ -25,7 +51,15 @@ def connect_to_genepattern(username, password):
 
     # Make the request of the GenePattern server
     url = settings.BASE_GENEPATTERN_URL + "/rest/v1/oauth2/token"
-    resp = requests.post(url, params=params, data='', headers={"Accept": "application/json"})
+    try:
+        resp = requests.post(url, params=params, data='', headers={"Accept": "application/json"},
+                             timeout=getattr(settings, 'GENEPATTERN_AUTH_TIMEOUT', 10))
+    except requests.Timeout:
+        # Do not hold every retry of these credentials open as long again while the server is slow
+        cache.set(key, UNAVAILABLE, getattr(settings, 'GENEPATTERN_AUTH_FAILURE_TTL', 30))
+        raise exceptions.AuthenticationFailed('Unable to verify credentials with GenePattern')
+    except requests.RequestException:
+        raise exceptions.AuthenticationFailed('Unable to verify credentials with GenePattern')
 
     # Handle the response
     if resp is not None and resp.status_code == 200:
@@ -41,11 +75,29 @@ def connect_to_genepattern(username, password):
             user.set_password(password)
             user.save()
 
+        # Reuse the token until it expires or the cache entry does, whichever is sooner
+        timeout = getattr(settings, 'GENEPATTERN_AUTH_TTL', 300)
+        if response_payload.get('expires_in'): timeout = min(timeout, int(response_payload['expires_in']))
+        cache.set(key, {'user': user.pk, 'token': response_payload['access_token']}, timeout)
+
         # Return the username
         return (user, response_payload['access_token'])
-    else:
+    elif resp is not None and resp.status_code in (400, 401):
         # This is likely a 400 Bad Request error due to an invalid username or password
+        cache.set(key, FAILED, getattr(settings, 'GENEPATTERN_AUTH_FAILURE_TTL', 30))
         raise exceptions.AuthenticationFailed('Invalid username or password')
+    else:
+        # The server is having trouble, so the credentials may well be valid
+        raise exceptions.AuthenticationFailed('Unable to verify credentials with GenePattern')
+
+
+def credentials_key(username, password):
+    """
+    Return the cache key of a pair of credentials, a hash salted with SECRET_KEY so that cached entries reveal
+    nothing about the password
+    """
+    digest = salted_hmac('library.auth.connect_to_genepattern', f'{username}\0{password}').hexdigest()
+    return f'genepattern-auth:{digest}'
 
 
 class GenePatternAuthenticationBackend(ModelBackend):
@@ -82,3 +134,48 @@ class GenePatternAuthentication(authentication.BaseAuthentication):
 
         # Call GenePattern server
         return connect_to_genepattern(username, password)
+
+
+def issue_token(user, scopes=TOKEN_SCOPES, lifetime=None):
+    """
+    Sign a token identifying the user, which SignedTokenAuthentication accepts until it expires
+    :param scopes: what the token allows, see TOKEN_SCOPES
+    :param lifetime: seconds until the token expires, defaults to SIGNED_TOKEN_LIFETIME
+    :return: (token, expiry timestamp)
+    """
+    expires = int(time.time()) + (lifetime or getattr(settings, 'SIGNED_TOKEN_LIFETIME', 3600))
+    payload = {'id': user.pk, 'name': user.username, 'staff': user.is_staff, 'superuser': user.is_superuser,
+               'scopes': list(scopes), 'exp': expires}
+    return signing.dumps(payload, salt=TOKEN_SALT), expires
+
+
+class SignedTokenAuthentication(authentication.BaseAuthentication):
+    """
+    Authenticate "Authorization: Bearer <token>" requests with a token from issue_token. The token is verified by
+    its signature alone, without looking the user up in the database, so a user who is deactivated keeps access
+    until their token expires. request.auth is the token's payload. Bearer tokens that are not in the format of
+    these tokens, such as GenePattern's, are left to the other authentication classes.
+    """
+    keyword = 'Bearer'
+
+    def authenticate(self, request):
+        header = authentication.get_authorization_header(request).split()
+        if len(header) != 2 or header[0].decode().lower() != self.keyword.lower(): return None
+        token = header[1].decode('latin-1')
+        if not TOKEN_FORMAT.fullmatch(token): return None
+
+        try:
+            payload = signing.loads(token, salt=TOKEN_SALT)
+        except signing.BadSignature:
+            raise exceptions.AuthenticationFailed('Invalid token')
+        if payload['exp'] < time.time(): raise exceptions.AuthenticationFailed('Token has expired')
+        required = 'read' if request.method in permissions.SAFE_METHODS else 'write'
+        if required not in payload['scopes']: raise exceptions.PermissionDenied(f'Token lacks the {required} scope')
+
+        user = User(pk=payload['id'], username=payload['name'], is_staff=payload['staff'],
+                    is_superuser=payload['superuser'], is_active=True)
+        return (user, payload)
+
+    def authenticate_header(self, request):
+        return self.keyword
+
@@ -0,0 +1,110 @@
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse, Http404
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag, urlquote
+
+CHUNK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def send_file(request, path, content_type=None, filename=None, etag=None):
+    """
+    Respond with a file, handing the transfer to the front-end web server if FILE_DELIVERY is set:
+      x-accel-redirect  nginx serves the file from the internal location FILE_DELIVERY_LOCATIONS maps its
+                        directory to, files outside those directories are sent by Django
+      x-sendfile        Apache mod_xsendfile or lighttpd serve the file at its path
+      python            Django sends it, with support for a single byte range
+    :param filename: name to offer the file for download as, if it is an attachment
+    :param etag: ETag of the file, if the caller has one
+    """
+    if not os.path.isfile(path): raise Http404
+    if content_type is None: content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    delivery = getattr(settings, 'FILE_DELIVERY', 'python')
+    location = internal_url(path) if delivery == 'x-accel-redirect' else None
+    if location:
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = location
+    elif delivery == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = path
+    else:
+        response = file_response(request, path, content_type, etag)
+
+    if etag: response['ETag'] = quote_etag(etag)
+    if filename: response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+def internal_url(path):
+    """
+    Return the nginx internal location of a file, or None if it is not under any of FILE_DELIVERY_LOCATIONS
+    """
+    path = os.path.realpath(path)
+    for directory, location in getattr(settings, 'FILE_DELIVERY_LOCATIONS', {}).items():
+        directory = os.path.realpath(directory)
+        if path.startswith(directory + os.sep):
+            return location.rstrip('/') + '/' + urlquote(os.path.relpath(path, directory))
+    return None
+
+
+def file_response(request, path, content_type, etag=None):
+    """
+    Send a file from Django. Whole files go through the server's wsgi.file_wrapper, which copies them to the
+    socket without reading them into Python where the server supports it.
+    """
+    stat = os.stat(path)
+    response = get_conditional_response(request, etag=quote_etag(etag) if etag else None,
+                                        last_modified=int(stat.st_mtime))
+    if response is None:
+        byte_range = parse_range(request, stat.st_size, etag, int(stat.st_mtime))
+        if byte_range is None:
+            response = FileResponse(open(path, 'rb'), content_type=content_type)
+            response['Content-Length'] = stat.st_size
+        elif byte_range == ():
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{stat.st_size}'
+        else:
+            start, end = byte_range
+            response = StreamingHttpResponse(read_range(path, start, end - start + 1), status=206,
+                                             content_type=content_type)
+            response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+            response['Content-Length'] = end - start + 1
+
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def parse_range(request, size, etag, last_modified):
+    """
+    Parse the Range header of a request for a single range of bytes
+    :return: None to send the whole file, () if the range cannot be satisfied, otherwise (first, last) byte
+    """
+    match = RANGE_RE.match(request.META.get('HTTP_RANGE', '').strip())
+    if not match or match.groups() == ('', ''): return None  # No range, several ranges or something else
+
+    # A range is only valid for the version of the file the client has part of
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range not in (quote_etag(etag) if etag else None, http_date(last_modified)): return None
+
+    first, last = match.groups()
+    if first and last and int(first) > int(last): return None  # Invalid, so ignored
+    if not first: first, last = max(size - int(last), 0), size - 1  # The last N bytes
+    else: first, last = int(first), min(int(last), size - 1) if last else size - 1
+    if first >= size or first > last: return ()
+    return first, last
+
+
+def read_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk: return
+            length -= len(chunk)
+            yield chunk
@@ -0,0 +1,61 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+import library.thumbnail as thumbnail
+from portal.models import PublishedProject
+
+
+def generate(id, force):
+    start = time.perf_counter()
+    result = thumbnail.generate(id, force=force)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+class Command(BaseCommand):
+    help = 'Generate the thumbnails of published notebooks across a pool of processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('ids', nargs='*', type=int, help='Published notebooks to generate, defaults to all')
+        parser.add_argument('--changed', action='store_true',
+                            help='Only notebooks updated since their thumbnails were last checked')
+        parser.add_argument('--force', action='store_true', help='Redraw thumbnails even if the preview is unchanged')
+        parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='Number of processes')
+
+    def handle(self, *args, **options):
+        projects = PublishedProject.objects.order_by('id')
+        if options['ids']: projects = projects.filter(id__in=options['ids'])
+        ids = [str(p.id) for p in projects
+               if not options['changed'] or not thumbnail.exists(p.id) or
+               datetime.fromtimestamp(os.path.getmtime(thumbnail.index_path(p.id)), p.updated.tzinfo) < p.updated]
+        connection.close()  # Do not share the database connection with the worker processes
+
+        written, unchanged, failed, downloaded = 0, 0, 0, 0
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            futures = {executor.submit(generate, id, options['force']): id for id in ids}
+            for future in as_completed(futures):
+                id = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f'{id:>8}: failed, {e}')
+                    continue
+
+                downloaded += result['bytes']
+                if result['written']: written += 1
+                else: unchanged += 1
+                if options['verbosity'] > 1:
+                    self.stdout.write(f'{id:>8}: {"written" if result["written"] else "unchanged"} '
+                                      f'in {result["seconds"] * 1000:.0f} ms')
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f'{len(ids)} notebooks in {elapsed:.1f} s ({len(ids) / elapsed if elapsed else 0:.1f}/s, '
+                          f'{downloaded / 1024 / 1024 / elapsed if elapsed else 0:.1f} MB/s downloaded): '
+                          f'{written} written, {unchanged} unchanged, {failed} failed')
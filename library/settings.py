@@ -159,6 +159,19 @@ FILE_UPLOAD_PERMISSIONS = 0o644
 USE_MODELTRANSLATION = False
 
 
+##########
+# CACHES #
+##########
+
+# Local memory by default, one cache per process. Also holds GenePattern login
+# checks and the catalog responses served to anonymous visitors.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+
 #############
 # DATABASES #
 #############
@@ -368,6 +381,7 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': (
+        'library.auth.SignedTokenAuthentication',
         'library.auth.GenePatternAuthentication',
         'rest_framework.authentication.TokenAuthentication',
         'rest_framework.authentication.BasicAuthentication',
@@ -388,6 +402,98 @@ LOGIN_REDIRECT_URL = '/'
 BASE_GENEPATTERN_URL = 'https://cloud.genepattern.org/gp'
 BASE_HUB_URL = "https://notebook.genepattern.org"
 
+# JupyterHub API client: (connect, read) timeout in seconds, retries for
+# idempotent calls, exponential backoff factor and connection pool size
+HUB_TIMEOUT = (3.05, 30)
+HUB_RETRIES = 3
+HUB_RETRY_BACKOFF = 0.3
+HUB_POOL_SIZE = 10
+
+# Library service archive work (publish, copy, export) is polled rather than
+# waited on over one connection: seconds between polls and seconds to wait for
+# an archive before giving up on it
+HUB_JOB_POLL_INTERVAL = 1
+HUB_ARCHIVE_TIMEOUT = 3600
+
+# Background spawn jobs: worker threads per process that stage projects and
+# request spawns from the hub, seconds between the readiness checks of the
+# spawns the hub accepted and seconds to wait for a server to become ready
+SPAWN_WORKERS = 8
+SPAWN_POLL_INTERVAL = 1
+SPAWN_TIMEOUT = 300
+
+# Cohort launches: default and maximum number of users whose servers are
+# staged and spawned at the same time
+COHORT_CONCURRENCY = 10
+COHORT_MAX_CONCURRENCY = 50
+
+# Seconds between keepalive comments on relayed spawn progress streams
+PROGRESS_KEEPALIVE = 8
+
+# Library thumbnails: background generation threads, seconds to wait for a
+# notebook preview and seconds before a failed thumbnail is tried again
+THUMBNAIL_WORKERS = 2
+THUMBNAIL_TIMEOUT = 30
+THUMBNAIL_RETRY = 300
+
+# Library thumbnail renditions (name: size in pixels) and seconds browsers may
+# cache the redirect from a thumbnail's URL to its current, immutable version.
+# AVIF renditions are only made if the pillow-avif-plugin package is installed.
+THUMBNAIL_RENDITIONS = {'card': 200, 'retina': 400, 'list': 64}
+THUMBNAIL_REDIRECT_MAX_AGE = 300
+
+# Thumbnail sprite sheets: most notebooks per sheet, tiles per row, seconds an
+# unused sheet is kept and most sheets queued for building at once
+THUMBNAIL_SPRITE_MAX = 100
+THUMBNAIL_SPRITE_COLUMNS = 10
+THUMBNAIL_SPRITE_RETENTION = 86400
+THUMBNAIL_SPRITE_PENDING = 8
+
+# Sending files (thumbnails, project archives): 'python' streams them from
+# Django, 'x-accel-redirect' hands them to nginx and 'x-sendfile' to Apache
+# mod_xsendfile or lighttpd. For nginx, map each directory to an internal
+# location, e.g. {'/data/repository/archives': '/protected/archives/'} with
+#     location /protected/archives/ { internal; alias /data/repository/archives/; }
+FILE_DELIVERY = 'python'
+FILE_DELIVERY_LOCATIONS = {}
+
+# Where the portal sees the published project repository of the library service
+REPOSITORY_DIR = '/data/repository'
+
+# Seconds a download is told to wait (Retry-After) while the library service
+# writes the archive of a notebook's new version
+EXPORT_RETRY_AFTER = 5
+
+# Seconds a successful GenePattern login (and its access token) or a rejected
+# one is remembered, so API clients do not verify credentials on every call
+GENEPATTERN_AUTH_TTL = 300
+GENEPATTERN_AUTH_FAILURE_TTL = 30
+
+# Seconds to wait for GenePattern to verify credentials. A login that times out
+# is refused, and remembered as such for GENEPATTERN_AUTH_FAILURE_TTL seconds.
+GENEPATTERN_AUTH_TIMEOUT = 10
+
+# Signed API tokens from /rest/api-auth/token/: default and maximum seconds
+# until they expire. They are signed with SECRET_KEY and cannot be revoked
+# individually, changing SECRET_KEY invalidates all of them.
+SIGNED_TOKEN_LIFETIME = 3600
+SIGNED_TOKEN_MAX_LIFETIME = 86400
+
+# Default and maximum page sizes of the notebook, project and tag lists when
+# a client opts in to cursor pagination with page_size or cursor
+PORTAL_PAGE_SIZE = 50
+PORTAL_MAX_PAGE_SIZE = 500
+
+# Most results /rest/notebooks/search/ returns at once
+SEARCH_MAX_RESULTS = 100
+
+# Cache of the notebook and tag responses served to anonymous visitors. Entries
+# are invalidated whenever the catalog changes, the timeout only bounds how long
+# unused ones take memory. Use a shared backend (memcached, redis) in CACHES to
+# share the rendered responses between processes.
+CATALOG_CACHE = 'default'
+CATALOG_CACHE_TIMEOUT = 300
+
 #####################
 # REST API SETTINGS #
 #####################
@@ -1,53 +1,311 @@
+import hashlib
+import io
+import json
+import math
 import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
-from PIL import Image
+from PIL import Image, features
 from library import settings
 
+try:
+    import pillow_avif  # Registers the AVIF plugin with Pillow if it is installed
+except ImportError:
+    pass
+
+THUMBNAIL_SIZE = 200
+STYLE = 1  # Increase when changing how thumbnails are drawn, so that generate_thumbnails redraws all of them
+
+# Renditions generated for every notebook: name -> width and height in pixels
+RENDITIONS = getattr(settings, 'THUMBNAIL_RENDITIONS', {'card': 200, 'retina': 400, 'list': 64})
+
+# Formats in order of preference: (file extension, media type, Pillow format, save options)
+FORMATS = [
+    ('avif', 'image/avif', 'AVIF', {'quality': 50}),
+    ('webp', 'image/webp', 'WEBP', {'quality': 80, 'method': 6}),
+    ('png', 'image/png', 'PNG', {'optimize': True}),
+]
+
+# Thumbnails are generated in the background, one job per notebook however many requests ask for it
+_executor = ThreadPoolExecutor(max_workers=getattr(settings, 'THUMBNAIL_WORKERS', 2))
+_pending = {}  # id -> future of the queued or running job
+_failed = {}  # id -> when its last generation failed
+_pending_sprites = {}  # sprite sheet key -> future of the queued or running build
+_lock = threading.Lock()
+
+
+def thumbnail_dir(id):
+    return os.path.join(settings.STATIC_ROOT, 'images', 'thumbnails', str(id))
 
-def thumbnail_path(id):
-    return os.path.join(settings.STATIC_ROOT, 'images', 'thumbnails', f'{id}.png')
+
+def thumbnail_path(id, version, rendition='card', extension='png'):
+    return os.path.join(thumbnail_dir(id), f'{rendition}-{version}.{extension}')
+
+
+def index_path(id):
+    return os.path.join(thumbnail_dir(id), 'index.json')
+
+
+def placeholder_path():
+    return os.path.join(settings.STATIC_ROOT, 'images', 'thumbnails', 'placeholder.png')
 
 
 def exists(id):
-    path = thumbnail_path(id)
-    return os.path.exists(path) and os.path.getsize(path) > 1024
+    return os.path.exists(index_path(id))
+
 
+def load_index(id):
+    """
+    Return the index of a notebook's renditions: the version of the preview they were made from and, for each
+    rendition, the extension and sha256 digest of every format it is available in
+    """
+    with open(index_path(id)) as f:
+        return json.load(f)
 
-def generate(id):
+
+def supported_formats():
+    Image.init()  # Load every plugin, so that Image.SAVE lists all the formats Pillow can write
+    return [f for f in FORMATS if f[2] in Image.SAVE and (f[2] != 'WEBP' or features.check('webp'))]
+
+
+def choose_format(available, accept):
+    """
+    Pick the preferred format of an image that the client accepts, falling back to PNG
+    :param available: dict of the image's file extensions to the sha256 digests of the files
+    :return: (file extension, media type, sha256 digest)
+    """
+    for extension, media_type, _, _ in FORMATS:
+        if extension in available and (media_type in accept or extension == 'png'):
+            return extension, media_type, available[extension]
+
+
+def enqueue(id):
+    """
+    Queue the generation of a thumbnail unless it is already queued or failed less than THUMBNAIL_RETRY seconds ago
+    :return: the future of the job, or None if it was not queued
+    """
+    with _lock:
+        if id in _pending: return _pending[id]
+        if time.time() - _failed.get(id, 0) < getattr(settings, 'THUMBNAIL_RETRY', 300): return None
+        _pending[id] = _executor.submit(_run, id)
+        return _pending[id]
+
+
+def _run(id):
+    try:
+        generate(id)
+        _failed.pop(id, None)
+    except Exception:
+        _failed[id] = time.time()
+        raise
+    finally:
+        with _lock:
+            del _pending[id]
+
+
+def generate(id, force=False):
+    """
+    Download a notebook's preview and write its renditions, unless they were already made from the same preview
+    in the current style
+    :return: dict with the number of bytes downloaded and whether renditions were written
+    """
     url = f'{settings.BASE_HUB_URL}/services/sharing/notebooks/{id}/preview/image/'
 
     # Lazily create thumbnail directory
-    filename = thumbnail_path(id)
-    create_directory(os.path.dirname(filename))
+    directory = thumbnail_dir(id)
+    create_directory(directory)
 
     # Download the preview image
-    r = requests.get(url)
-    thumb_file = open(filename, 'wb')
-    thumb_file.write(r.content)
-    thumb_file.close()
+    r = requests.get(url, timeout=getattr(settings, 'THUMBNAIL_TIMEOUT', 30))
+    r.raise_for_status()
 
-    # Overwrite it with the thumbnail
-    create_thumbnail(filename)
+    # The version covers the preview and the way it is drawn, so restyled thumbnails get new URLs too
+    version = hashlib.sha256(r.content + style().encode()).hexdigest()[:16]
+    if not force and exists(id) and load_index(id)['version'] == version:
+        os.utime(index_path(id))  # Checked against the current preview
+        return {'bytes': len(r.content), 'written': False}
 
+    # Decode no more of the preview than the largest rendition needs
+    preview = Image.open(io.BytesIO(r.content))
+    preview = reduce_image(preview, max(RENDITIONS.values()))
+
+    # Write every rendition in every format, then the index that makes them visible. Files are named after the
+    # version, so the content behind a URL never changes once it has been served.
+    index = {'version': version, 'renditions': {}}
+    for rendition, size in RENDITIONS.items():
+        im = create_thumbnail(preview, size)
+        index['renditions'][rendition] = {}
+        for extension, _, image_format, options in supported_formats():
+            path = thumbnail_path(id, version, rendition, extension)
+            index['renditions'][rendition][extension] = write_image(im, path, image_format, options)
+    write_atomic(index_path(id), json.dumps(index).encode())
+
+    # Remove the renditions of previous versions
+    for name in os.listdir(directory):
+        if name != 'index.json' and f'-{version}.' not in name and not name.endswith('.tmp'):
+            os.remove(os.path.join(directory, name))
+    return {'bytes': len(r.content), 'written': True}
 
-def create_directory(directory_path):
-    if not os.path.exists(directory_path):
-        os.mkdir(directory_path)
 
+def style():
+    """
+    Identify the way thumbnails are drawn: the renditions, the formats they are written in and STYLE
+    """
+    return json.dumps([STYLE, RENDITIONS, [(f[0], f[3]) for f in supported_formats()]], sort_keys=True)
 
-def create_thumbnail(filename):
-    desired_size = 200
 
-    im = Image.open(filename)
+def reduce_image(im, desired_size):
+    """
+    Shrink an image cheaply to at least twice desired_size wide, with the top square cropped from tall images,
+    before it is resampled properly. JPEG previews are decoded at reduced scale.
+    """
+    im.draft('RGB', (desired_size * 2, desired_size * 2))  # Only JPEG supports decoding at a lower scale
+    width, height = im.size
+    im = im.crop((0, 0, width, min(width, height))).convert('RGB')  # Thumbnails only show the top of the preview
+
+    factor = width // (desired_size * 2)
+    if factor > 1 and hasattr(im, 'reduce'): im = im.reduce(factor)  # Pillow 7 and later
+    return im
+
+
+def sprite_path(key, extension):
+    return os.path.join(settings.STATIC_ROOT, 'images', 'thumbnails', 'sprites', f'{key}.{extension}')
+
+
+def load_sprite(key):
+    with open(sprite_path(key, 'json')) as f:
+        return json.load(f)
+
+
+def sprite(ids, rendition='card'):
+    """
+    Return the map of a sprite sheet holding the thumbnails of the given notebooks, or None while the sheet is built
+    in the background. The sheet is keyed by the version of every member, so it is replaced whenever one of their
+    thumbnails changes. Notebooks without a thumbnail are queued for generation, and the sheet is only built once
+    none is being generated, rather than again as each one finishes. Those that failed get the placeholder.
+    :return: dict with the sheet's key, its tile size and dimensions, the position of each notebook's tile and the
+             sha256 digest of the sheet in each format
+    """
+    members, generating = [], False
+    for id in ids:
+        if exists(id): members.append((id, load_index(id)['version']))
+        else:
+            generating = enqueue(id) is not None or generating
+            members.append((id, None))
+    if generating: return None
+
+    key = hashlib.sha256(json.dumps([rendition, members]).encode()).hexdigest()[:16]
+    if os.path.exists(sprite_path(key, 'json')):
+        os.utime(sprite_path(key, 'json'))  # Keep sheets in use from being pruned
+        return load_sprite(key)
+
+    with _lock:
+        if key not in _pending_sprites and len(_pending_sprites) < getattr(settings, 'THUMBNAIL_SPRITE_PENDING', 8):
+            _pending_sprites[key] = _executor.submit(_build_sprite, key, rendition, members)
+    return None
+
+
+def _build_sprite(key, rendition, members):
+    try:
+        size = RENDITIONS[rendition]
+        columns = min(len(members), getattr(settings, 'THUMBNAIL_SPRITE_COLUMNS', 10))
+        sheet = Image.new('RGB', (columns * size, math.ceil(len(members) / columns) * size), (255, 255, 255))
+        tiles = {}
+        for i, (id, version) in enumerate(members):
+            x, y = i % columns * size, i // columns * size
+            try:
+                tile = Image.open(thumbnail_path(id, version, rendition) if version else placeholder())
+            except FileNotFoundError:  # Replaced by a newer version since the index was read
+                tile, version = Image.open(placeholder()), None
+            if tile.size != (size, size): tile = tile.resize((size, size), Image.ANTIALIAS)
+            sheet.paste(tile, (x, y))
+            tiles[id] = {'x': x, 'y': y, 'ready': version is not None}
+
+        create_directory(os.path.dirname(sprite_path(key, 'json')))
+        sprite_map = {'key': key, 'rendition': rendition, 'size': size, 'width': sheet.width, 'height': sheet.height,
+                      'tiles': tiles, 'formats': {}}
+        for extension, _, image_format, options in supported_formats():
+            sprite_map['formats'][extension] = write_image(sheet, sprite_path(key, extension), image_format, options)
+        write_atomic(sprite_path(key, 'json'), json.dumps(sprite_map).encode())
+        prune_sprites()
+    finally:
+        with _lock:
+            del _pending_sprites[key]
+
+
+def prune_sprites():
+    """
+    Delete sprite sheets whose map has not been built or used for THUMBNAIL_SPRITE_RETENTION seconds
+    """
+    directory = os.path.dirname(sprite_path('', 'json'))
+    cutoff = time.time() - getattr(settings, 'THUMBNAIL_SPRITE_RETENTION', 86400)
+    for name in os.listdir(directory):
+        key, extension = os.path.splitext(name)
+        path = os.path.join(directory, name)
+        if extension != '.json' or not os.path.exists(path) or os.path.getmtime(path) >= cutoff: continue
+        for extension in [f[0] for f in FORMATS] + ['json']:
+            try:
+                os.remove(sprite_path(key, extension))
+            except FileNotFoundError:
+                pass  # Not written in this format, or pruned by another process
+
+
+def placeholder():
+    """
+    Return the path of the image served while a thumbnail is being generated, creating it the first time
+    """
+    filename = placeholder_path()
+    if not os.path.exists(filename):
+        create_directory(os.path.dirname(filename))
+        source = getattr(settings, 'THUMBNAIL_PLACEHOLDER',
+                         os.path.join(settings.STATIC_ROOT, 'images', 'jupyter-gray.png'))
+
+        im = Image.open(source)
+        im.thumbnail((THUMBNAIL_SIZE // 2, THUMBNAIL_SIZE // 2), Image.ANTIALIAS)
+        new_im = Image.new("RGB", (THUMBNAIL_SIZE, THUMBNAIL_SIZE), (255, 255, 255))
+        new_im.paste(im, ((THUMBNAIL_SIZE - im.width) // 2, (THUMBNAIL_SIZE - im.height) // 2),
+                     im if im.mode == 'RGBA' else None)
+        write_image(new_im, filename, 'PNG', {})
+    return filename
+
+
+def create_directory(directory_path):
+    os.makedirs(directory_path, exist_ok=True)
+
+
+def create_thumbnail(im, desired_size=THUMBNAIL_SIZE):
     old_width, old_height = im.size  # old_size[0] is in (width, height) format
 
-    new_height = int(float(old_height * desired_size) / old_width)
+    new_height = min(int(float(old_height * desired_size) / old_width), desired_size)
 
+    im = im.crop((0, 0, old_width, int(float(new_height * old_width) / desired_size)))
     im = im.resize((desired_size, new_height), Image.ANTIALIAS)
-    im = im.crop((0, 0, desired_size, desired_size))
 
     # create a new image and paste the resized on it
     new_im = Image.new("RGB", (desired_size, desired_size), (255, 255, 255, 0))
     new_im.paste(im, (0, 0))
+    return new_im
+
+
+def write_image(im, filename, image_format, options):
+    """
+    Save an image atomically
+    :return: the sha256 digest of the file
+    """
+    tmp_filename = f'{filename}.{uuid.uuid4().hex}.tmp'
+    im.save(tmp_filename, image_format, **options)
+    with open(tmp_filename, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    os.replace(tmp_filename, filename)
+    return digest
+
 
-    new_im.save(filename)
+def write_atomic(filename, data):
+    tmp_filename = f'{filename}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_filename, filename)
@@ -15,7 +15,8 @@ from mezzanine_api.views import PageViewSet, PostViewSet, CategoryViewSet, SiteV
 from rest_framework import routers
 
 import portal.urls
-from library.views import dashboard, jobs, analyses, run_analysis, serve_thumbnail, library, workspace, logout, docs
+from library.views import dashboard, jobs, analyses, run_analysis, serve_thumbnail, thumbnail_sprite, serve_sprite, \
+    library, workspace, logout, docs, SignedTokenView
 
 admin.autodiscover()
 
@@ -39,6 +40,7 @@ urlpatterns = i18n_patterns(
 
     # Django REST Framework
     # url(r'^rest/', include('rest_framework.urls', namespace='rest_framework')),
+    url(r'^rest/api-auth/token/$', SignedTokenView.as_view()),
     url(r'^rest/api-auth/', include('rest_framework.urls', namespace='rest_framework')),
     url(r'^rest/', include(router.urls)),
 
@@ -46,7 +48,12 @@ urlpatterns = i18n_patterns(
     url(r'^rest/', include(portal.urls.router.urls)),
 
     # Notebook Library
+    url(r'^thumbnail/sprite/$', thumbnail_sprite),
+    url(r'^thumbnail/sprite/(?P<key>[0-9a-f]+)/$', serve_sprite, name='thumbnail-sprite'),
     url(r'^thumbnail/(?P<id>[0-9]+)/$', serve_thumbnail),
+    url(r'^thumbnail/(?P<id>[0-9]+)/(?P<rendition>\w+)/$', serve_thumbnail),
+    url(r'^thumbnail/(?P<id>[0-9]+)/(?P<rendition>\w+)\.(?P<version>[0-9a-f]+)/$', serve_thumbnail,
+        name='thumbnail'),
     url(r'^dashboard/$', dashboard),
     url(r'^workspace/$', workspace),
     url(r'^library/$', library),
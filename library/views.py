@@ -1,10 +1,20 @@
 import os
-from django.http import HttpResponse
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse, Http404
 from django.template import loader
-from django.views.static import serve
+from django.utils.cache import get_conditional_response
 from django.contrib.auth import logout as logout_user
 from django.shortcuts import redirect
+from django.urls import reverse
+from django.utils.http import quote_etag
+from rest_framework import authentication, permissions, serializers
+from rest_framework.response import Response
+from rest_framework.views import APIView
 import library.thumbnail as thumbnail
+from library.auth import GenePatternAuthentication, TOKEN_SCOPES, issue_token
+from library.delivery import send_file
+from portal.models import PublishedProject
 
 
 def logout(request):
@@ -12,15 +22,95 @@ def logout(request):
     return redirect('/')
 
 
-def serve_thumbnail(request, id):
-    # Lazily generate thumbnail if it does not exist
-    if not thumbnail.exists(id):
-        thumbnail.generate(id)
+def serve_thumbnail(request, id, rendition='card', version=None):
+    if rendition not in thumbnail.RENDITIONS: raise Http404
+
+    # Lazily generate thumbnail in the background if it does not exist, serving a placeholder until it is ready
+    if not thumbnail.exists(id): return serve_placeholder(request, id)
+
+    # Renditions added to THUMBNAIL_RENDITIONS since the thumbnail was made appear once it is made again
+    index = thumbnail.load_index(id)
+    if rendition not in index['renditions']: return serve_placeholder(request, id)
 
-    path = thumbnail.thumbnail_path(id)
+    # Send unversioned URLs to the current version, whose content never changes and can be cached forever
+    if version != index['version']:
+        response = redirect('thumbnail', id=id, rendition=rendition, version=index['version'])
+        response['Cache-Control'] = f'public, max-age={getattr(settings, "THUMBNAIL_REDIRECT_MAX_AGE", 300)}'
+        return response
 
-    # Serve the file
-    response = serve(request, os.path.basename(path), os.path.dirname(path))
+    # Serve the best format the browser accepts
+    available = index['renditions'][rendition]
+    extension, media_type, digest = thumbnail.choose_format(available, request.META.get('HTTP_ACCEPT', ''))
+    return serve_immutable(request, thumbnail.thumbnail_path(id, index['version'], rendition, extension), media_type,
+                           digest)
+
+
+def serve_placeholder(request, id):
+    """
+    Queue the generation of a notebook's thumbnail and serve the placeholder meanwhile
+    """
+    thumbnail.enqueue(id)
+    response = send_file(request, thumbnail.placeholder())
+    response['Cache-Control'] = 'no-cache'  # So the browser asks again for the real thumbnail
+    return response
+
+
+def thumbnail_sprite(request):
+    """
+    Return the map of a sprite sheet holding the thumbnails of the published notebooks listed in ?ids=, with the URL
+    of the sheet. Pass ?rendition= for a rendition other than card. While the sheet is built in the background, answer
+    202 with a map that has no URL, and show the placeholder until asking again.
+    """
+    rendition = request.GET.get('rendition', 'card')
+    ids = {int(id) for id in request.GET.get('ids', '').split(',') if id.isdigit()}
+    if rendition not in thumbnail.RENDITIONS: return HttpResponseBadRequest('Unknown rendition')
+    if not ids: return HttpResponseBadRequest('No notebook ids given')
+    if len(ids) > getattr(settings, 'THUMBNAIL_SPRITE_MAX', 100): return HttpResponseBadRequest('Too many ids')
+
+    # In a canonical order, so that every permutation of a page shares the sheet
+    ids = [str(pk) for pk in PublishedProject.objects.filter(pk__in=ids).order_by('pk').values_list('pk', flat=True)]
+    if not ids: raise Http404
+
+    sprite_map = thumbnail.sprite(ids, rendition)
+    if sprite_map is None:
+        placeholder = os.path.relpath(thumbnail.placeholder(), settings.STATIC_ROOT)
+        response = JsonResponse({'url': None, 'ready': False, 'size': thumbnail.RENDITIONS[rendition], 'tiles': {},
+                                 'placeholder': f'{settings.STATIC_URL}{placeholder}'}, status=202)
+        response['Retry-After'] = '2'
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+    etag = f'"{sprite_map["key"]}"'
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = JsonResponse({'url': reverse('thumbnail-sprite', kwargs={'key': sprite_map['key']}), 'ready': True,
+                                 'size': sprite_map['size'], 'width': sprite_map['width'],
+                                 'height': sprite_map['height'], 'tiles': sprite_map['tiles']})
+    response['ETag'] = etag
+    response['Cache-Control'] = 'no-cache'  # The sheet changes whenever one of its thumbnails does
+    return response
+
+
+def serve_sprite(request, key):
+    try:
+        sprite_map = thumbnail.load_sprite(key)
+    except FileNotFoundError:
+        raise Http404
+
+    extension, media_type, digest = thumbnail.choose_format(sprite_map['formats'], request.META.get('HTTP_ACCEPT', ''))
+    return serve_immutable(request, thumbnail.sprite_path(key, extension), media_type, digest)
+
+
+def serve_immutable(request, path, media_type, digest):
+    """
+    Serve a file whose URL changes whenever its content does, letting browsers cache it forever
+    """
+    etag = digest[:32]
+    response = get_conditional_response(request, etag=quote_etag(etag))
+    if response is None: response = send_file(request, path, media_type, etag=etag)
+    response['ETag'] = quote_etag(etag)
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response['Vary'] = 'Accept'
     return response
 
 
@@ -72,3 +162,35 @@ def run_analysis(request, lsid):
     return HttpResponse(template.render({'lsid': lsid}, request))
 
 
+class ScopesField(serializers.ListField):
+    """
+    A list of token scopes, or a single scope
+    """
+    child = serializers.ChoiceField(TOKEN_SCOPES)
+
+    def to_internal_value(self, data):
+        return super(ScopesField, self).to_internal_value([data] if isinstance(data, str) else data)
+
+
+class SignedTokenSerializer(serializers.Serializer):
+    scopes = ScopesField(required=False, allow_empty=False)
+    lifetime = serializers.IntegerField(required=False, allow_null=True)
+
+
+class SignedTokenView(APIView):
+    """
+    Exchange GenePattern credentials, or an existing session, for a signed API token. POST username and password,
+    and optionally scopes (a list from TOKEN_SCOPES) and lifetime (seconds, at most SIGNED_TOKEN_MAX_LIFETIME).
+    """
+    authentication_classes = (GenePatternAuthentication, authentication.SessionAuthentication)
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request):
+        serializer = SignedTokenSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        scopes = serializer.validated_data.get('scopes') or TOKEN_SCOPES
+        lifetime = serializer.validated_data.get('lifetime') or getattr(settings, 'SIGNED_TOKEN_LIFETIME', 3600)
+        lifetime = max(1, min(lifetime, getattr(settings, 'SIGNED_TOKEN_MAX_LIFETIME', 86400)))
+
+        token, expires = issue_token(request.user, scopes, lifetime)
+        return Response({'token': token, 'expires': expires, 'scopes': list(scopes)})
@@ -0,0 +1,13 @@
+from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+class PortalConfig(AppConfig):
+    name = 'portal'
+
+    def ready(self):
+        import portal.signals  # Connect the receivers that keep the search index and tag counters up to date
+        from portal.facets import recount
+        from portal.search import create_index
+        post_migrate.connect(create_index, sender=self)
+        post_migrate.connect(recount, sender=self)
@@ -0,0 +1,68 @@
+import functools
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+
+from portal.models import Generation
+
+CATALOG = 'catalog'  # Published notebooks, their source projects' tags and owners, and tags
+CACHED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Cache-Control', 'Vary')
+
+
+def generation(name=CATALOG):
+    return Generation.objects.filter(name=name).values_list('value', flat=True).first() or 0
+
+
+def bump(name=CATALOG):
+    """
+    Change the generation of the cached responses, which invalidates all of them in every process at once
+    """
+    if not Generation.objects.filter(name=name).update(value=F('value') + 1):
+        Generation.objects.get_or_create(name=name, defaults={'value': 1})
+
+
+def anonymous_cache(view_method):
+    """
+    Serve the responses of a catalog view to anonymous users from CATALOG_CACHE, keyed by the request and the
+    catalog generation, so that they are rendered once per change of the catalog instead of once per request.
+    Authenticated users, whose responses may differ, always get the view.
+    """
+    @functools.wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        # Only JSON is the same for every visitor: the browsable API embeds the visitor's CSRF token
+        if request.user and request.user.is_authenticated or request.accepted_renderer.format != 'json':
+            return view_method(self, request, *args, **kwargs)
+
+        cache = caches[getattr(settings, 'CATALOG_CACHE', 'default')]
+        path = f'{request.get_full_path()} {request.accepted_media_type}'
+        key = f'portal:{CATALOG}:{generation()}:{hashlib.sha256(path.encode()).hexdigest()}'
+        cached = cache.get(key)
+        if cached is not None:
+            content, headers = cached
+            response = get_conditional_response(request, etag=headers.get('ETag'))  # Conditional requests too
+            if response is None: response = HttpResponse(content)
+            for header, value in headers.items(): response[header] = value
+            return response
+
+        response = view_method(self, request, *args, **kwargs)
+        if response.status_code == 200:
+            def store(rendered):
+                if not shareable(request, rendered): return
+                headers = {header: rendered[header] for header in CACHED_HEADERS if rendered.has_header(header)}
+                cache.set(key, (rendered.content, headers), getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300))
+            response.add_post_render_callback(store)
+        return response
+    return wrapper
+
+
+def shareable(request, response):
+    """
+    Whether a response can be served to other visitors: it sets no cookies, does not vary by cookie and did not
+    use the visitor's CSRF token
+    """
+    vary = [header.strip().lower() for header in response.get('Vary', '').split(',')]
+    return not response.cookies and 'cookie' not in vary and not request.META.get('CSRF_COOKIE_USED')
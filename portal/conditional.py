@@ -0,0 +1,39 @@
+import hashlib
+import json
+
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+
+class ConditionalListMixin(object):
+    """
+    Answer list requests with 304 Not Modified when nothing in the listed collection changed since the client's
+    copy, found with one aggregate query before anything is serialized. The version of a collection is the number
+    of objects in it and the latest of their version_fields, as seen by the requesting user.
+    """
+    version_fields = ('updated',)  # Timestamps that change whenever anything the list renders changes
+
+    def list_version(self, request):
+        """
+        :return: (ETag, Last-Modified timestamp or None) of the list the request asks for
+        """
+        aggregates = {field: Max(field) for field in self.version_fields}
+        values = self.filter_queryset(self.get_queryset()).order_by().aggregate(count=Count('pk', distinct=True), **aggregates)
+        timestamps = [values[field] for field in self.version_fields if values[field] is not None]
+        last_modified = max(timestamps).timestamp() if timestamps else None
+
+        key = [values['count'], [values[field] and values[field].isoformat() for field in self.version_fields],
+               request.user.pk, request.accepted_renderer.format]
+        return hashlib.sha256(json.dumps(key).encode()).hexdigest()[:32], last_modified
+
+    def list(self, request, *args, **kwargs):
+        etag, last_modified = self.list_version(request)
+        # Only the ETag decides: deletions do not move Last-Modified, and it has a resolution of a second
+        response = get_conditional_response(request, etag=quote_etag(etag))
+        if response is None: response = super(ConditionalListMixin, self).list(request, *args, **kwargs)
+
+        response['ETag'] = quote_etag(etag)
+        if last_modified: response['Last-Modified'] = http_date(last_modified)
+        patch_cache_control(response, private=True, no_cache=True)  # Revalidate on every use, which is cheap
+        return response
@@ -0,0 +1,62 @@
+from django.db.models import Case, Count, F, IntegerField, Sum, When
+
+from portal.models import Project, PublishedProject, Tag
+
+Tagging = Project.tags.through
+
+
+def adjust(labels, published=0, private=0):
+    """
+    Add to the published and private project counters of the given tags
+    """
+    if not labels or not (published or private): return
+    Tag.objects.filter(label__in=labels).update(published_count=F('published_count') + published,
+                                                private_count=F('private_count') + private)
+
+
+def tagged(project, labels, sign):
+    """
+    Count a project as tagged (sign 1) or untagged (sign -1) with the given tags
+    """
+    if PublishedProject.objects.filter(source=project).exists(): adjust(labels, published=sign)
+    else: adjust(labels, private=sign)
+
+
+def tagging(tag, project_ids, sign):
+    """
+    Count the given projects as tagged (sign 1) or untagged (sign -1) with a tag
+    """
+    published = PublishedProject.objects.filter(source__in=project_ids).count()
+    adjust([tag.label], published=sign * published, private=sign * (len(project_ids) - published))
+
+
+def published(project_id, sign):
+    """
+    Move the tags of a project from the private counters to the published ones (sign 1) or back (sign -1)
+    """
+    adjust(list(Tagging.objects.filter(project_id=project_id).values_list('tag_id', flat=True)),
+           published=sign, private=-sign)
+
+
+def counts(projects):
+    """
+    Aggregate the number of published and private projects using each tag
+    :param projects: queryset of the projects to count
+    :return: dict of tag labels to (published, private)
+    """
+    rows = Tagging.objects.filter(project__in=projects.values('pk')).values('tag').annotate(
+        total=Count('project'),
+        published=Sum(Case(When(project__published__isnull=False, then=1), default=0, output_field=IntegerField())))
+    return {row['tag']: (row['published'], row['total'] - row['published']) for row in rows}
+
+
+def recount(**kwargs):
+    """
+    Set the counters of every tag from an aggregation of the whole catalog. Connected to post_migrate, so that
+    counters added to an existing catalog start out right.
+    """
+    totals = counts(Project.objects.all())
+    for tag in Tag.objects.all():
+        published, private = totals.get(tag.label, (0, 0))
+        if (tag.published_count, tag.private_count) != (published, private):
+            Tag.objects.filter(label=tag.label).update(published_count=published, private_count=private)
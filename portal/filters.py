@@ -0,0 +1,72 @@
+from django_filters import rest_framework as filters
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import OrderingFilter
+
+from portal.models import Project, PublishedProject
+
+
+def labels(value):
+    return [label.strip().lower() for label in value.split(',') if label.strip()]
+
+
+class TaggedFilterSet(filters.FilterSet):
+    """
+    Filter projects by tag: tags=a,b matches projects tagged with all of the labels, tags_any=a,b those tagged
+    with any of them
+    """
+    tags = filters.CharFilter(method='filter_tags_all', label='Tagged with all of these comma separated labels')
+    tags_any = filters.CharFilter(method='filter_tags_any', label='Tagged with any of these comma separated labels')
+    project_field = 'pk'  # Field of the filtered model that references the project
+
+    def filter_tags_all(self, queryset, name, value):
+        for label in labels(value):
+            queryset = queryset.filter(**{f'{self.project_field}__in': self.tagged([label])})
+        return queryset
+
+    def filter_tags_any(self, queryset, name, value):
+        return queryset.filter(**{f'{self.project_field}__in': self.tagged(labels(value))})
+
+    @staticmethod
+    def tagged(labels):
+        # Search the join table by tag instead of joining it to every row, which would also duplicate rows
+        return Project.tags.through.objects.filter(tag__in=labels).values('project')
+
+
+class ProjectFilter(TaggedFilterSet):
+    authors = filters.CharFilter(lookup_expr='icontains')
+
+    class Meta:
+        model = Project
+        fields = ('image', 'quality', 'authors', 'tags', 'tags_any')
+
+
+class PublishedProjectFilter(TaggedFilterSet):
+    authors = filters.CharFilter(lookup_expr='icontains')
+    published_after = filters.DateTimeFilter(field_name='published', lookup_expr='gte')
+    published_before = filters.DateTimeFilter(field_name='published', lookup_expr='lt')
+    updated_after = filters.DateTimeFilter(field_name='updated', lookup_expr='gte')
+    updated_before = filters.DateTimeFilter(field_name='updated', lookup_expr='lt')
+    project_field = 'source'
+
+    class Meta:
+        model = PublishedProject
+        fields = ('image', 'quality', 'authors', 'tags', 'tags_any', 'published_after', 'published_before',
+                  'updated_after', 'updated_before')
+
+
+class CursorOrderingFilter(OrderingFilter):
+    """
+    Ordering that keeps cursor pagination a seek on an index: every ordering ends with the primary key, so that ties
+    are broken the same way on every page, and once the client paginates only the view's cursor_ordering_fields may
+    come first. Cursors seek on the first field, which must be a timestamp rather than a count like copied, that is
+    shared by many rows and changes while the client pages through them.
+    """
+
+    def get_ordering(self, request, queryset, view):
+        ordering = list(super(CursorOrderingFilter, self).get_ordering(request, queryset, view))
+        if view.paginator is not None and view.paginator.get_page_size(request) is not None and \
+                ordering[0].lstrip('-') not in view.cursor_ordering_fields:
+            raise ValidationError({self.ordering_param: [f'Pages can only be ordered by '
+                                                         f'{", ".join(view.cursor_ordering_fields)}.']})
+        if ordering[-1].lstrip('-') not in ('id', 'pk'): ordering.append('-id' if ordering[0].startswith('-') else 'id')
+        return ordering
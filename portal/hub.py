@@ -1,7 +1,13 @@
+import contextlib
+import json
+import threading
+import time
 import urllib.parse
+
 import requests
-import json
 from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 def encode_name(raw_name):
@@ -13,70 +19,251 @@ def encode_name(raw_name):
         .replace('%', '-')
 
 
-def user_exists(user):
-    user = encode_name(str(user))
-    response = requests.get(f'{settings.BASE_HUB_URL}/hub/api/users/{user}',
-                             headers={'Authorization': f'token {settings.HUB_TOKEN}'})
-    return response.status_code == 200
+class HubError(RuntimeError):
+    """
+    The JupyterHub API returned an unexpected response
+    """
 
+    def __init__(self, message, status_code=None):
+        super(HubError, self).__init__(message)
+        self.status_code = status_code
 
-def create_user(user):
-    user = encode_name(str(user))
-    response = requests.post(f'{settings.BASE_HUB_URL}/hub/api/users/{user}',
-                             headers={'Authorization': f'token {settings.HUB_TOKEN}'})
-    if response.status_code == 201 or response.status_code == 200: return True
-    else: raise RuntimeError(response.text)
 
+class HubNotFound(HubError):
+    """
+    The requested user, server or service does not exist on the hub
+    """
+    pass
 
-def spawn_server(user, server_name, image, copy=False):
-    user = encode_name(str(user))
-    # server_name = encode_name(str(server_name))
 
-    data = {'image': image}
-    if copy:
-        data['project_copy'] = '/data/repository/tabor-Hello2.zip'
+class HubUnavailable(HubError):
+    """
+    The hub could not be reached, timed out or kept returning server errors
+    """
+    pass
+
+
+class HubClient:
+    """
+    Client for the JupyterHub REST API and the hub's library service
+
+    A single instance is shared by the whole Django process so that connections to the hub are pooled and kept
+    alive between requests. Every call has a timeout. Idempotent calls are retried with exponential backoff on
+    connection errors and gateway errors, other calls are only retried if the connection could not be established.
+    Archive work is submitted to the library service without waiting on the connection, then its job is polled for
+    up to archive_timeout seconds, however long the archive takes.
+    """
+
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+    RETRY_STATUSES = (502, 503, 504)
+
+    def __init__(self, base_url, token, timeout=(3.05, 30), retries=3, backoff=0.3, pool_size=10,
+                 archive_timeout=3600, poll_interval=1):
+        self.base_url = base_url.rstrip('/')
+        self.token = token
+        self.timeout = timeout
+        self.archive_timeout = archive_timeout
+        self.poll_interval = poll_interval
+
+        retry = Retry(total=retries, connect=retries, read=retries, status=retries, backoff_factor=backoff,
+                      status_forcelist=self.RETRY_STATUSES, method_whitelist=self.IDEMPOTENT_METHODS,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, path, auth=True, timeout=None, **kwargs):
+        """
+        Make a request of the hub, translating transport failures into HubUnavailable
+        :param method: HTTP method
+        :param path: path relative to BASE_HUB_URL
+        :param auth: whether to send the hub API token
+        :param timeout: (connect, read) timeout overriding the client default
+        :return: requests.Response
+        """
+        headers = kwargs.pop('headers', {})
+        if auth: headers['Authorization'] = f'token {self.token}'
+        try:
+            return self.session.request(method, f'{self.base_url}{path}', headers=headers,
+                                        timeout=timeout or self.timeout, **kwargs)
+        except requests.exceptions.RequestException as e:
+            raise HubUnavailable(f'{method} {path} failed: {e}')
+
+    @staticmethod
+    def check(response, *ok_statuses):
+        """
+        Return the response if its status is expected, otherwise raise the matching HubError
+        """
+        if response.status_code in ok_statuses: return response
+        elif response.status_code == 404: raise HubNotFound(response.text, response.status_code)
+        elif response.status_code >= 500: raise HubUnavailable(response.text, response.status_code)
+        else: raise HubError(response.text, response.status_code)
+
+    def user_exists(self, user, timeout=None):
+        user = encode_name(str(user))
+        response = self.request('GET', f'/hub/api/users/{user}', timeout=timeout)
+        return response.status_code == 200
+
+    def create_user(self, user, timeout=None):
+        user = encode_name(str(user))
+        self.check(self.request('POST', f'/hub/api/users/{user}', timeout=timeout), 200, 201)
+        return True
+
+    def spawn_server(self, user, server_name, image, copy=False, timeout=None):
+        user = encode_name(str(user))
+        # server_name = encode_name(str(server_name))
+
+        data = {'image': image}
+        if copy:
+            data['project_copy'] = '/data/repository/tabor-Hello2.zip'
+
+        response = self.request('POST', f'/hub/api/users/{user}/servers/{server_name}', data=json.dumps(data),
+                                timeout=timeout)
+
+        if response.status_code == 400 and 'already running' in response.text: return True
+        self.check(response, 200, 201, 202)  # 202 means the spawn is still pending after the hub's slow_spawn_timeout
+        return True
+
+    def stop_server(self, user, server_name, remove_server=False, timeout=None):
+        user = encode_name(str(user))
+        # server_name = encode_name(str(server_name))
+        response = self.request('DELETE', f'/hub/api/users/{user}/servers/{server_name}',
+                                data=json.dumps({"remove": remove_server}), timeout=timeout)
+        self.check(response, 200, 202, 204)
+        return True
 
-    response = requests.post(f'{settings.BASE_HUB_URL}/hub/api/users/{user}/servers/{server_name}',
-                             headers={'Authorization': f'token {settings.HUB_TOKEN}'},
-                             data=json.dumps(data))
+    def server_status(self, user, server_name, timeout=None):
+        """
+        Return the hub's model of a named server ('ready', 'pending', 'url', ...) or None if it is not active
+        """
+        user = encode_name(str(user))
+        response = self.check(self.request('GET', f'/hub/api/users/{user}', timeout=timeout), 200)
+        return (response.json().get('servers') or {}).get(server_name)
 
-    if response.status_code == 201 or response.status_code == 200: return True
-    elif response.status_code == 400 and 'already running' in response.text: return True
-    else: raise RuntimeError(response.text)
+    def progress(self, user, server_name, timeout=None):
+        """
+        Iterate over the events of the hub's spawn progress event-stream for a named server
+        :return: generator of event dicts, ending after the ready or failed event
+        """
+        user = encode_name(str(user))
+        response = self.check(self.request('GET', f'/hub/api/users/{user}/servers/{server_name}/progress',
+                                           headers={'Accept': 'text/event-stream'}, stream=True, timeout=timeout),
+                              200)
+        with contextlib.closing(response):
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'): continue  # Keepalive newlines
+                event = json.loads(line[len('data:'):])
+                yield event
+                if event.get('ready') or event.get('failed'): return
+
+    def submit_library_job(self, method, path, timeout=None, **kwargs):
+        """
+        Submit archive work to the library service, which answers with its job as soon as it is queued
+        :return: the job, a dict with its 'id', 'state' ('queued', 'running', 'done' or 'failed'), 'result' and 'error'
+        """
+        separator = '&' if '?' in path else '?'
+        response = self.request(method, f'{path}{separator}wait=false', auth=False, timeout=timeout, **kwargs)
+        return self.check(response, 200, 201, 202).json()
+
+    def library_job(self, id, timeout=None):
+        return self.check(self.request('GET', f'/services/library/jobs/{id}', auth=False, timeout=timeout), 200).json()
+
+    def wait_for_library_job(self, job, timeout=None):
+        """
+        Poll a library job until it is finished, raising HubError if it failed and HubUnavailable if it is still
+        running after timeout seconds (archive_timeout by default)
+        :return: the finished job
+        """
+        deadline = time.monotonic() + (timeout or self.archive_timeout)
+        while job['state'] not in ('done', 'failed'):
+            if time.monotonic() > deadline: raise HubUnavailable(f'Library job {job["id"]} is still {job["state"]}')
+            time.sleep(self.poll_interval)
+            job = self.library_job(job['id'])
+        if job['state'] == 'failed': raise HubError(f'Library job {job["id"]} failed: {job["error"]}')
+        return job
+
+    def zip_project(self, id, user, server_name, timeout=None):
+        user = urllib.parse.quote(encode_name(str(user)))
+        server = urllib.parse.quote(server_name)
+        job = self.submit_library_job('POST', f'/services/library/?id={id}&user={user}&server={server}',
+                                      data=json.dumps({"id": id, "user": user, "server": server}))
+        self.wait_for_library_job(job, timeout=timeout)
+        return True
+
+    def unzip_project(self, copy, user, server_name, timeout=None):
+        user = urllib.parse.quote(encode_name(str(user)))
+        server = urllib.parse.quote(server_name)
+        job = self.submit_library_job('GET', f'/services/library/?copy={copy}&user={user}&server={server}')
+        self.wait_for_library_job(job, timeout=timeout)
+        return True
+
+    def export_project(self, id, timeout=None):
+        """
+        Ask the library service for a zip archive of a published project without waiting for it to be written
+        :return: path of the archive relative to the repository directory, or None while it is being written
+        """
+        job = self.submit_library_job('GET', f'/services/library/export/?id={urllib.parse.quote(id)}', timeout=timeout)
+        if job['state'] == 'failed': raise HubError(f'Library job {job["id"]} failed: {job["error"]}')
+        return job['result'] if job['state'] == 'done' else None
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Return the HubClient shared by this process, lazily creating it from the Django settings
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = HubClient(settings.BASE_HUB_URL, settings.HUB_TOKEN,
+                                    timeout=getattr(settings, 'HUB_TIMEOUT', (3.05, 30)),
+                                    retries=getattr(settings, 'HUB_RETRIES', 3),
+                                    backoff=getattr(settings, 'HUB_RETRY_BACKOFF', 0.3),
+                                    pool_size=getattr(settings, 'HUB_POOL_SIZE', 10),
+                                    archive_timeout=getattr(settings, 'HUB_ARCHIVE_TIMEOUT', 3600),
+                                    poll_interval=getattr(settings, 'HUB_JOB_POLL_INTERVAL', 1))
+    return _client
+
+
+def user_exists(user):
+    return get_client().user_exists(user)
+
+
+def create_user(user):
+    return get_client().create_user(user)
+
+
+def spawn_server(user, server_name, image, copy=False):
+    return get_client().spawn_server(user, server_name, image, copy=copy)
 
 
 def stop_server(user, server_name, remove_server=False):
-    user = encode_name(str(user))
-    # server_name = encode_name(str(server_name))
-    response = requests.delete(f'{settings.BASE_HUB_URL}/hub/api/users/{user}/servers/{server_name}',
-                             headers={'Authorization': f'token {settings.HUB_TOKEN}'},
-                             data=json.dumps({"remove": remove_server}))
+    return get_client().stop_server(user, server_name, remove_server=remove_server)
+
 
-    if response.status_code == 204 or response.status_code == 200: return True
-    else: raise RuntimeError(response.text)
+def server_status(user, server_name):
+    return get_client().server_status(user, server_name)
 
 
 def delete_server(user, server_name):
     try:
         stop_server(user, server_name, remove_server=True)
-    except RuntimeError as response:
-        if '404' in repr(response): pass
-        else: raise response
+    except HubNotFound:
+        pass
 
 
 def zip_project(id, user, server_name):
-    user = urllib.parse.quote(encode_name(str(user)))
-    server = urllib.parse.quote(server_name)
-    response = requests.post(f'{settings.BASE_HUB_URL}/services/library/?id={id}&user={user}&server={server}',
-                             data=json.dumps({"id": id, "user": user, "server": server}))
-
-    if response.status_code == 201 or response.status_code == 200: return True
-    else: raise RuntimeError(response.text)
+    return get_client().zip_project(id, user, server_name)
 
 
 def unzip_project(copy, user, server_name):
-    user = urllib.parse.quote(encode_name(str(user)))
-    server = urllib.parse.quote(server_name)
-    response = requests.get(f'{settings.BASE_HUB_URL}/services/library/?copy={copy}&user={user}&server={server}')
-    if response.status_code == 201 or response.status_code == 200: return True
-    else: raise RuntimeError(response.text)
\ No newline at end of file
+    return get_client().unzip_project(copy, user, server_name)
+
+
+def export_project(id):
+    return get_client().export_project(id)
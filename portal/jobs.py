@@ -0,0 +1,136 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from portal.hub import spawn_server, unzip_project, server_status, user_exists, create_user
+from portal.models import SpawnJob
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Return the thread pool shared by this process for talking to the hub in the background
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'SPAWN_WORKERS', 8))
+    return _executor
+
+
+def submit_spawn(user, server_name, image, project=None, copy=''):
+    """
+    Record a queued SpawnJob and hand it to the background executor once the surrounding transaction commits
+    :return: SpawnJob
+    """
+    job = SpawnJob.objects.create(user=user, project=project, server_name=server_name, image=image, copy=copy)
+    transaction.on_commit(lambda: get_executor().submit(run_spawn_job, job.pk))
+    return job
+
+
+def submit_batch(users, server_name, image, copy='', requested_by=None, concurrency=None):
+    """
+    Queue a SpawnJob per user and run them on a dedicated pool so that at most `concurrency` of them talk to the
+    hub at once, however large the batch
+    :return: (batch id, list of SpawnJob)
+    """
+    batch = uuid.uuid4().hex
+    concurrency = concurrency or getattr(settings, 'COHORT_CONCURRENCY', 10)
+    with transaction.atomic():
+        jobs = [SpawnJob.objects.create(user=user, requested_by=requested_by, server_name=server_name, image=image,
+                                        copy=copy, batch=batch) for user in users]
+
+    def start():
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        for job in jobs: executor.submit(run_spawn_job, job.pk)
+        executor.shutdown(wait=False)  # Threads exit once the queue is drained
+
+    transaction.on_commit(start)
+    return batch, jobs
+
+
+def run_spawn_job(pk):
+    """
+    Create the hub user and copy the project files if necessary, then ask the hub to spawn the server. The worker
+    is released as soon as the hub accepts the spawn, the poller thread waits for the server to become ready.
+    """
+    try:
+        job = SpawnJob.objects.select_related('user').get(pk=pk)
+        set_state(job, SpawnJob.STAGING)
+        try:
+            if not user_exists(job.user): create_user(job.user)  # Users who have never logged in to the hub
+            if job.copy: unzip_project(copy=job.copy, user=job.user, server_name=job.server_name)
+            spawn_server(user=job.user, server_name=job.server_name, image=job.image)
+        except Exception as e:
+            set_state(job, SpawnJob.FAILED, str(e))
+        else:
+            set_state(job, SpawnJob.SPAWNING)
+            watch(job)
+    finally:
+        connection.close()  # Worker threads do not go through Django's request cycle
+
+
+_watched = {}  # SpawnJob pk -> (SpawnJob, deadline) of the spawns the hub accepted, until their server is ready
+_watched_lock = threading.Lock()
+_poller = None
+
+
+def watch(job):
+    """
+    Have the poller thread mark a spawning job ready once its server is, starting the thread if it is not running
+    """
+    global _poller
+    deadline = time.monotonic() + getattr(settings, 'SPAWN_TIMEOUT', 300)
+    with _watched_lock:
+        _watched[job.pk] = (job, deadline)
+        if _poller is None:
+            _poller = threading.Thread(target=poll_readiness, daemon=True)
+            _poller.start()
+
+
+def poll_readiness():
+    """
+    Check the servers of the watched jobs every SPAWN_POLL_INTERVAL seconds, exiting once none is left. A job fails
+    if its server stops or is not ready within SPAWN_TIMEOUT seconds.
+    """
+    global _poller
+    interval = getattr(settings, 'SPAWN_POLL_INTERVAL', 1)
+    try:
+        while True:
+            with _watched_lock:
+                if not _watched:
+                    _poller = None  # Under the lock, so that a job watched from now on starts a new thread
+                    return
+                watched = list(_watched.values())
+
+            for job, deadline in watched:
+                try:
+                    server = server_status(job.user, job.server_name)
+                    if server is None: raise RuntimeError(f'Server {job.server_name} is no longer running')
+                    if not server.get('ready'):
+                        if time.monotonic() < deadline: continue
+                        raise RuntimeError(f'Timed out waiting for server {job.server_name} to start')
+                    set_state(job, SpawnJob.READY)
+                except Exception as e:
+                    set_state(job, SpawnJob.FAILED, str(e))
+                with _watched_lock:
+                    del _watched[job.pk]
+            time.sleep(interval)
+    finally:
+        with _watched_lock:
+            if _poller is threading.current_thread(): _poller = None  # Died, the next watch starts a new thread
+        connection.close()
+
+
+def set_state(job, state, message=''):
+    job.state = state
+    job.message = message
+    job.save(update_fields=['state', 'message', 'updated'])
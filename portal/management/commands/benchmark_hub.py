@@ -0,0 +1,45 @@
+import statistics
+import time
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from portal.hub import HubClient, encode_name
+
+
+class Command(BaseCommand):
+    help = 'Compare JupyterHub API latency using bare requests calls and the pooled HubClient'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--requests', type=int, default=50, help='Number of API calls per strategy')
+        parser.add_argument('-u', '--user', type=str, default='admin', help='Hub user to look up')
+        parser.add_argument('--url', type=str, default=None, help='Hub URL, defaults to BASE_HUB_URL')
+
+    def handle(self, *args, **options):
+        base_url = options['url'] or settings.BASE_HUB_URL
+        user = encode_name(options['user'])
+        headers = {'Authorization': f'token {settings.HUB_TOKEN}'}
+        count = options['requests']
+
+        # One new connection (TCP and TLS handshake) per call, the way portal.hub used to work
+        def bare():
+            requests.get(f'{base_url}/hub/api/users/{user}', headers=headers)
+
+        # Keep-alive connections from the shared pool
+        client = HubClient(base_url, settings.HUB_TOKEN)
+
+        def pooled():
+            client.request('GET', f'/hub/api/users/{user}')
+
+        for label, call in (('bare requests', bare), ('pooled HubClient', pooled)):
+            call()  # Warm up DNS and, for the pooled client, the first connection
+            timings = []
+            for i in range(count):
+                start = time.perf_counter()
+                call()
+                timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            self.stdout.write(f'{label:>18}: mean {statistics.mean(timings):8.2f} ms   '
+                              f'p50 {timings[len(timings) // 2]:8.2f} ms   '
+                              f'p95 {timings[int(len(timings) * 0.95) - 1]:8.2f} ms')
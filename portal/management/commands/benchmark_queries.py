@@ -0,0 +1,59 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from portal.models import Project, ProjectAccess, PublishedProject, Tag
+from portal.views import ProjectViewSet, PublishedProjectViewSet
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Count the queries made by the project and notebook list endpoints as the catalog grows. ' \
+           'Sample data is created in a transaction that is rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-s', '--sizes', type=str, default='10,100,500', help='Comma separated catalog sizes')
+
+    def handle(self, *args, **options):
+        endpoints = (('/rest/projects/', ProjectViewSet), ('/rest/notebooks/', PublishedProjectViewSet))
+        factory = APIRequestFactory()
+
+        try:
+            with transaction.atomic():
+                admin = User.objects.create(username='benchmark-admin', is_staff=True)
+                tags = [Tag.objects.create(label=f'benchmark-tag-{i}') for i in range(5)]
+                created = 0
+                for size in sorted(int(size) for size in options['sizes'].split(',')):
+                    for i in range(created, size):
+                        self.create_notebook(i, tags)
+                    created = size
+
+                    results = []
+                    for path, viewset in endpoints:
+                        request = factory.get(path)
+                        force_authenticate(request, user=admin)
+                        view = viewset.as_view({'get': 'list'})
+                        start = time.perf_counter()
+                        with CaptureQueriesContext(connection) as queries:
+                            view(request).render()
+                        results.append(f'{path} {len(queries):4d} queries {(time.perf_counter() - start) * 1000:8.1f} ms')
+                    self.stdout.write(f'{size:6d} notebooks: ' + '   '.join(results))
+                raise Rollback
+        except Rollback:
+            pass
+
+    @staticmethod
+    def create_notebook(i, tags):
+        owner = User.objects.create(username=f'benchmark-user-{i}')
+        project = Project.objects.create(name=f'Benchmark {i}', image='genepattern/notebook', path=f'benchmark-{i}',
+                                         dir_name=f'benchmark-{i}')
+        project.tags.add(*tags[:i % len(tags) + 1])
+        ProjectAccess.objects.create(user=owner, project=project, owner=True)
+        PublishedProject.objects.create(name=project.name, image=project.image, source=project, path=project.path)
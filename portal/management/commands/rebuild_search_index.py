@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from portal import search
+from portal.models import PublishedProject
+
+
+class Command(BaseCommand):
+    help = 'Index the whole notebook catalog for search again, for changes made without sending signals ' \
+           '(such as queryset updates)'
+
+    def handle(self, *args, **options):
+        if search.backend() is None:
+            self.stdout.write('The database has no full-text search, notebooks are searched by substring')
+            return
+        if search.TABLE in connection.introspection.table_names(): search.rebuild()
+        else: search.create_index()
+        self.stdout.write(f'Indexed {PublishedProject.objects.count()} notebooks with {search.backend()}')
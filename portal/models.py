@@ -7,6 +7,11 @@ class Tag(models.Model):
     protected = models.BooleanField(default=False)
     pinned = models.BooleanField(default=False)
 
+    # Projects using the tag, kept up to date by portal.signals for the facets endpoint
+    published_count = models.IntegerField(default=0, editable=False)
+    private_count = models.IntegerField(default=0, editable=False)
+    updated = models.DateTimeField(auto_now=True, null=True)
+
     def __str__(self): return self.label
 
 
@@ -23,6 +28,12 @@ class Project(models.Model):
     authors = models.CharField(max_length=256, blank=True)
     quality = models.CharField(max_length=32, blank=True)
 
+    # Also touched by portal.signals when its tags, access or publication change, as these are rendered with it
+    updated = models.DateTimeField(auto_now=True, null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['image']), models.Index(fields=['quality'])]  # Filtered on by the API
+
     def __str__(self): return self.name
 
 
@@ -54,4 +65,49 @@ class PublishedProject(models.Model):
     updated = models.DateTimeField(auto_now=True)
     copied = models.IntegerField(default=1)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['updated', 'id']),  # Seeked by cursor pagination of the notebooks
+            models.Index(fields=['published']),      # Filtered on or ordered by the API
+            models.Index(fields=['copied']),
+            models.Index(fields=['image']),
+            models.Index(fields=['quality']),
+        ]
+
     def __str__(self): return self.name
+
+
+class SpawnJob(models.Model):
+    QUEUED = 'queued'
+    STAGING = 'staging'    # Creating the hub user and copying the project files
+    SPAWNING = 'spawning'  # The hub accepted the spawn, waiting for the server to be ready
+    READY = 'ready'
+    FAILED = 'failed'
+    STATES = ((QUEUED, 'Queued'), (STAGING, 'Staging'), (SPAWNING, 'Spawning'), (READY, 'Ready'), (FAILED, 'Failed'))
+
+    user = models.ForeignKey(User, related_name='spawn_jobs')
+    requested_by = models.ForeignKey(User, null=True, related_name='requested_spawn_jobs')
+    project = models.ForeignKey(Project, null=True, related_name='spawn_jobs')
+
+    server_name = models.CharField(max_length=256)
+    image = models.CharField(max_length=64)
+    copy = models.CharField(max_length=256, blank=True)
+    batch = models.CharField(max_length=32, blank=True, db_index=True)
+
+    state = models.CharField(max_length=16, choices=STATES, default=QUEUED)
+    message = models.TextField(blank=True)
+
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self): return f'{self.user} | {self.server_name} | {self.state}'
+
+
+class Generation(models.Model):
+    """
+    A counter bumped whenever what it covers changes, which versions the cached responses built from it
+    """
+    name = models.CharField(max_length=32, primary_key=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self): return f'{self.name} | {self.value}'
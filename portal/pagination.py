@@ -0,0 +1,30 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class OptInCursorPagination(CursorPagination):
+    """
+    Cursor pagination that only applies when the client asks for it with the page_size or cursor parameter, so
+    existing clients keep receiving the whole list. Pages are found by seeking on an indexed ordering, which costs
+    the same on the last page as on the first, and are stable while notebooks are published or updated.
+    """
+    page_size = getattr(settings, 'PORTAL_PAGE_SIZE', 50)
+    max_page_size = getattr(settings, 'PORTAL_MAX_PAGE_SIZE', 500)
+    page_size_query_param = 'page_size'
+
+    def get_page_size(self, request):
+        params = request.query_params
+        if self.page_size_query_param not in params and self.cursor_query_param not in params: return None
+        return super(OptInCursorPagination, self).get_page_size(request)
+
+
+class NotebookPagination(OptInCursorPagination):
+    ordering = ('-updated', '-id')  # Most recently updated first, backed by the (updated, id) index
+
+
+class ProjectPagination(OptInCursorPagination):
+    ordering = '-id'
+
+
+class TagPagination(OptInCursorPagination):
+    ordering = 'label'  # The primary key
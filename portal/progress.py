@@ -0,0 +1,133 @@
+import json
+import threading
+import time
+
+import requests
+from django.conf import settings
+from django.db import connection
+from django.http import StreamingHttpResponse
+from rest_framework.renderers import BaseRenderer
+
+from portal.hub import get_client, encode_name, HubError
+from portal.models import SpawnJob
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    Lets DRF negotiate text/event-stream and renders any error payload as a single server-sent event
+    """
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return format_event(data)
+
+
+def format_event(event):
+    return f'data: {json.dumps(event)}\n\n'
+
+
+class ProgressRelay:
+    """
+    A single upstream connection to the hub's spawn progress stream for one server, shared by every viewer
+
+    Events are kept for the lifetime of the relay so that viewers who connect late replay the spawn from the start.
+    The relay removes itself from the registry once the hub reports the server as ready or failed. While the spawn
+    job of the server is queued or staging the hub knows nothing of the spawn, so the relay waits for the job first.
+    """
+
+    def __init__(self, key, user, server_name):
+        self.key = key
+        self.events = []
+        self.finished = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._pump, args=(user, server_name), daemon=True)
+        self.thread.start()
+
+    def _pump(self, user, server_name):
+        try:
+            job = self._wait_for_spawn(user, server_name)
+            if job is not None and job.state == SpawnJob.FAILED:
+                self._publish({'progress': 100, 'failed': True, 'message': job.message})
+                return
+            for event in get_client().progress(user, server_name):
+                self._publish(event)
+        except (HubError, requests.RequestException, ValueError) as e:
+            # Errors reading the stream or decoding an event end it too, subscribers must not be left without an ending
+            self._publish({'progress': 100, 'failed': True, 'message': str(e)})
+        finally:
+            with _relays_lock:
+                if _relays.get(self.key) is self: del _relays[self.key]
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+            connection.close()  # Relay threads do not go through Django's request cycle
+
+    def _wait_for_spawn(self, user, server_name):
+        """
+        Wait until the latest spawn job of the server has asked the hub to spawn it, or for as long as staging a
+        project may take
+        :return: the job, or None if the server has none
+        """
+        interval = getattr(settings, 'SPAWN_POLL_INTERVAL', 1)
+        deadline = time.monotonic() + getattr(settings, 'HUB_ARCHIVE_TIMEOUT', 3600)
+        waiting = False
+        while True:
+            job = latest_spawn(user, server_name)
+            if job is None or job.state not in (SpawnJob.QUEUED, SpawnJob.STAGING) or time.monotonic() > deadline:
+                return job
+            if not waiting: self._publish({'progress': 0, 'message': 'Preparing the server'})
+            waiting = True
+            time.sleep(interval)
+
+    def _publish(self, event):
+        with self.condition:
+            self.events.append(event)
+            self.condition.notify_all()
+
+    def subscribe(self, keepalive):
+        """
+        Yield server-sent event chunks as the hub publishes them, with a comment line every keepalive seconds
+        """
+        sent = 0
+        while True:
+            with self.condition:
+                if sent == len(self.events) and not self.finished: self.condition.wait(timeout=keepalive)
+                pending = self.events[sent:]
+                done = self.finished
+            sent += len(pending)
+            if pending: yield ''.join(format_event(event) for event in pending)
+            elif done: return
+            else: yield ': keepalive\n\n'
+
+
+def latest_spawn(user, server_name):
+    return SpawnJob.objects.filter(user=user, server_name=server_name).order_by('-created', '-id').first()
+
+
+_relays = {}
+_relays_lock = threading.Lock()
+
+
+def get_relay(user, server_name):
+    """
+    Return the running relay for this user's server, opening the upstream connection if there is none
+    """
+    key = (encode_name(str(user)), server_name)
+    with _relays_lock:
+        relay = _relays.get(key)
+        if relay is None: relay = _relays[key] = ProgressRelay(key, user, server_name)
+    return relay
+
+
+def progress_response(user, server_name):
+    """
+    Stream the spawn progress of a user's named server to the client as server-sent events
+    """
+    relay = get_relay(user, server_name)
+    response = StreamingHttpResponse(relay.subscribe(getattr(settings, 'PROGRESS_KEEPALIVE', 8)),
+                                     content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Keep nginx from buffering the stream
+    return response
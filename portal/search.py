@@ -0,0 +1,162 @@
+import re
+
+from django.db import connection
+from django.db.models import Q
+from django.utils.html import escape
+
+from portal.models import PublishedProject
+
+TABLE = 'portal_notebook_search'
+MAX_TERMS = 10
+START, STOP = '\x02', '\x03'  # Mark matches in the text, replaced by <mark> tags once the text is escaped
+
+# Weights of the indexed columns in the ranking
+WEIGHTS = {'name': 10.0, 'description': 1.0, 'authors': 5.0, 'tags': 5.0}
+
+_backends = {}  # Database vendor -> search backend
+
+
+def backend():
+    """
+    Return the full-text search backend of the database: 'fts5' for SQLite builds with FTS5, 'postgresql', or None
+    if searches fall back to matching substrings
+    """
+    if connection.vendor not in _backends:
+        if connection.vendor == 'postgresql': _backends[connection.vendor] = 'postgresql'
+        elif connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+                _backends[connection.vendor] = 'fts5' if cursor.fetchone()[0] else None
+        else: _backends[connection.vendor] = None
+    return _backends[connection.vendor]
+
+
+def create_index(**kwargs):
+    """
+    Create the search index if it does not exist and fill it with the catalog. Connected to post_migrate.
+    """
+    if backend() is None or TABLE in connection.introspection.table_names(): return
+    with connection.cursor() as cursor:
+        if backend() == 'fts5':
+            cursor.execute(f"CREATE VIRTUAL TABLE {TABLE} USING fts5(name, description, authors, tags, "
+                           f"tokenize='porter unicode61')")
+        else:
+            cursor.execute(f'CREATE TABLE {TABLE} (id integer PRIMARY KEY, document tsvector NOT NULL)')
+            cursor.execute(f'CREATE INDEX {TABLE}_document ON {TABLE} USING gin (document)')
+    rebuild()
+
+
+def rebuild():
+    """
+    Index the whole catalog again
+    """
+    if backend() is None: return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE}')
+    for notebook in PublishedProject.objects.select_related('source').prefetch_related('source__tags'):
+        index(notebook)
+
+
+def document(notebook):
+    """
+    Return the text of a notebook that is indexed: its name, description, authors and the source project's tags
+    """
+    tags = ' '.join(tag.label for tag in notebook.source.tags.all()) if notebook.source else ''
+    return [notebook.name, notebook.description, notebook.authors, tags]
+
+
+def index(notebook):
+    """
+    Add a notebook to the search index or update its entry
+    """
+    if backend() is None: return
+    with connection.cursor() as cursor:
+        if backend() == 'fts5':
+            cursor.execute(f'DELETE FROM {TABLE} WHERE rowid = %s', [notebook.pk])
+            cursor.execute(f'INSERT INTO {TABLE} (rowid, name, description, authors, tags) VALUES (%s, %s, %s, %s, %s)',
+                           [notebook.pk] + document(notebook))
+        else:
+            cursor.execute(f"INSERT INTO {TABLE} (id, document) VALUES (%s, "
+                           f"setweight(to_tsvector('english', %s), 'A') || "
+                           f"setweight(to_tsvector('english', %s), 'C') || "
+                           f"setweight(to_tsvector('english', %s), 'B') || "
+                           f"setweight(to_tsvector('english', %s), 'B')) "
+                           f"ON CONFLICT (id) DO UPDATE SET document = EXCLUDED.document",
+                           [notebook.pk] + document(notebook))
+
+
+def remove(id):
+    """
+    Remove a notebook from the search index
+    """
+    if backend() is None: return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE} WHERE {"rowid" if backend() == "fts5" else "id"} = %s', [id])
+
+
+def terms(query):
+    """
+    Split a query into the words it searches for, ignoring any operators of the search syntax
+    """
+    return re.findall(r'\w+', query)[:MAX_TERMS]
+
+
+def search(query, limit, offset=0):
+    """
+    Search the catalog for notebooks matching every word of the query, each of which may be the prefix of a word
+    :return: list of (id, rank, highlighted name, highlighted extract of the description) by descending rank.
+             Matches are wrapped in <mark> tags and the rest of the text is escaped.
+    """
+    words = terms(query)
+    if not words: return []
+    if backend() == 'fts5': rows = _search_fts5(words, limit, offset)
+    elif backend() == 'postgresql': rows = _search_postgresql(words, limit, offset)
+    else: rows = _search_substrings(words, limit, offset)
+    return [(id, rank, mark(name), mark(description)) for id, rank, name, description in rows]
+
+
+def _search_fts5(words, limit, offset):
+    weights = ', '.join(str(WEIGHTS[column]) for column in ('name', 'description', 'authors', 'tags'))
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT rowid, -bm25({TABLE}, {weights}), highlight({TABLE}, 0, %s, %s), "
+                       f"snippet({TABLE}, 1, %s, %s, '…', 32) FROM {TABLE} WHERE {TABLE} MATCH %s "
+                       f"ORDER BY bm25({TABLE}, {weights}), rowid LIMIT %s OFFSET %s",
+                       [START, STOP, START, STOP, ' '.join(f'"{word}"*' for word in words), limit, offset])
+        return cursor.fetchall()
+
+
+def _search_postgresql(words, limit, offset):
+    options = f'StartSel={START}, StopSel={STOP}, HighlightAll=true'
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT p.id, ts_rank_cd(s.document, q), ts_headline('english', p.name, q, %s), "
+                       f"ts_headline('english', p.description, q, %s) "
+                       f"FROM {TABLE} s JOIN {PublishedProject._meta.db_table} p ON p.id = s.id, "
+                       f"to_tsquery('english', %s) q WHERE s.document @@ q "
+                       f"ORDER BY 2 DESC, p.id LIMIT %s OFFSET %s",
+                       [options, options.replace(', HighlightAll=true', ', MaxWords=32'),
+                        ' & '.join(f'{word}:*' for word in words), limit, offset])
+        return cursor.fetchall()
+
+
+def _search_substrings(words, limit, offset):
+    """
+    Match the words as substrings of any indexed field, ranking notebooks by the weight of the fields that match
+    """
+    notebooks = PublishedProject.objects.select_related('source').prefetch_related('source__tags')
+    for word in words:
+        notebooks = notebooks.filter(Q(name__icontains=word) | Q(description__icontains=word) |
+                                     Q(authors__icontains=word) | Q(source__tags__label__icontains=word))
+
+    pattern = re.compile('|'.join(re.escape(word) for word in words), re.IGNORECASE)
+    results = []
+    for notebook in notebooks.distinct():
+        fields = dict(zip(('name', 'description', 'authors', 'tags'), document(notebook)))
+        rank = sum(WEIGHTS[field] * len(pattern.findall(text)) for field, text in fields.items())
+        results.append((notebook.pk, rank, pattern.sub(lambda m: START + m.group() + STOP, notebook.name),
+                        pattern.sub(lambda m: START + m.group() + STOP, notebook.description)))
+    results.sort(key=lambda result: (-result[1], result[0]))
+    return results[offset:offset + limit]
+
+
+def mark(text):
+    return escape(text or '').replace(START, '<mark>').replace(STOP, '</mark>')
@@ -1,7 +1,30 @@
 from django.contrib.auth.models import User, Group
+from django.db import transaction
 from rest_framework import serializers
 
-from portal.models import Tag, Project, ProjectAccess, PublishedProject
+from portal.models import Tag, Project, ProjectAccess, PublishedProject, SpawnJob
+from portal.utils import create_tags, normalize_tags
+
+
+class TagsField(serializers.Field):
+    """
+    Tags as a list of labels, validated as normalized labels. The serializer saving them creates the tags not yet
+    used, with a constant number of queries however many there are.
+    """
+    default_error_messages = {
+        'not_a_list': 'Expected a list of labels but got type "{input_type}".',
+        'max_length': 'Labels may have no more than {max_length} characters: {labels}.',
+    }
+
+    def to_representation(self, value):
+        return [tag.label for tag in value.all()]  # Served from the prefetched tags
+
+    def to_internal_value(self, data):
+        if isinstance(data, str) or not hasattr(data, '__iter__'): self.fail('not_a_list', input_type=type(data).__name__)
+        max_length = Tag._meta.get_field('label').max_length
+        too_long = [label for label in normalize_tags(data) if len(label) > max_length]
+        if too_long: self.fail('max_length', max_length=max_length, labels=', '.join(too_long))
+        return normalize_tags(data)
 
 
 class UserSerializer(serializers.HyperlinkedModelSerializer):
@@ -23,15 +46,30 @@ class TagSerializer(serializers.HyperlinkedModelSerializer):
 
 
 class ProjectSerializer(serializers.HyperlinkedModelSerializer):
-    tags = serializers.PrimaryKeyRelatedField(many=True, read_only=False, queryset=Tag.objects.all())
+    tags = TagsField(required=False)
 
     class Meta:
         model = Project
         fields = ('url', 'name', 'image', 'path', 'dir_name', 'default', 'tags', 'description', 'authors', 'quality')
 
+    # Tags are only created once the whole project is valid, and are rolled back with it if saving it fails
+    def create(self, validated_data):
+        labels = validated_data.pop('tags', None)
+        with transaction.atomic():
+            project = super(ProjectSerializer, self).create(validated_data)
+            if labels is not None: project.tags.set(create_tags(labels))
+        return project
+
+    def update(self, instance, validated_data):
+        labels = validated_data.pop('tags', None)
+        with transaction.atomic():
+            project = super(ProjectSerializer, self).update(instance, validated_data)
+            if labels is not None: project.tags.set(create_tags(labels))
+        return project
+
 
 class ProjectGetSerializer(serializers.HyperlinkedModelSerializer):
-    tags = serializers.PrimaryKeyRelatedField(many=True, read_only=False, queryset=Tag.objects.all())
+    tags = TagsField(required=False)
 
     class Meta:
         model = Project
@@ -58,9 +96,30 @@ class PublishedProjectSerializer(serializers.HyperlinkedModelSerializer):
 
 
 class PublishedProjectGetSerializer(serializers.HyperlinkedModelSerializer):
-    tags = serializers.PrimaryKeyRelatedField(many=True, read_only=False, source='source.tags', queryset=Tag.objects.all())
+    tags = TagsField(source='source.tags', read_only=True)
     owners = serializers.StringRelatedField(many=True, read_only=True, source='source.access')
 
     class Meta:
         model = PublishedProject
-        fields = ('url', 'name', 'image', 'source', 'path', 'default', 'description', 'authors', 'quality', 'published', 'updated', 'tags', 'owners')
\ No newline at end of file
+        fields = ('url', 'name', 'image', 'source', 'path', 'default', 'description', 'authors', 'quality', 'published', 'updated', 'tags', 'owners')
+
+
+class CohortSerializer(serializers.Serializer):
+    """
+    Users and groups to launch a notebook for, and how many of their servers to start at once
+    """
+    users = serializers.ListField(child=serializers.CharField(), required=False, default=list)
+    groups = serializers.ListField(child=serializers.CharField(), required=False, default=list)
+    concurrency = serializers.IntegerField(min_value=1, required=False)
+
+    def validate(self, data):
+        if not data['users'] and not data['groups']: raise serializers.ValidationError('No users or groups given.')
+        return data
+
+
+class SpawnJobSerializer(serializers.HyperlinkedModelSerializer):
+    user = serializers.StringRelatedField()
+
+    class Meta:
+        model = SpawnJob
+        fields = ('url', 'user', 'project', 'server_name', 'image', 'batch', 'state', 'message', 'created', 'updated')
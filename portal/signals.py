@@ -0,0 +1,143 @@
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+
+from portal import cache, facets, search
+from portal.models import Project, ProjectAccess, PublishedProject, Tag
+
+
+@receiver(post_save, sender=PublishedProject)
+def index_notebook(sender, instance, **kwargs):
+    search.index(instance)
+
+
+@receiver(post_delete, sender=PublishedProject)
+def remove_notebook(sender, instance, **kwargs):
+    search.remove(instance.pk)
+
+
+@receiver(m2m_changed, sender=Project.tags.through)
+def remember_untagged(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Before tags are removed, remember which of the projects (or tags, for a project) are really linked: pk_set
+    holds whatever the caller passed to remove(), and is None for clear()
+    """
+    if action not in ('pre_remove', 'pre_clear'): return
+    links = facets.Tagging.objects.filter(tag=instance) if reverse else facets.Tagging.objects.filter(project=instance)
+    if action == 'pre_remove': links = links.filter(**{'project__in' if reverse else 'tag__in': pk_set})
+    instance._untagged = set(links.values_list('project_id' if reverse else 'tag_id', flat=True))
+
+
+@receiver(m2m_changed, sender=Project.tags.through)
+def index_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Reindex the published notebooks whose source project's tags changed, from either side of the relation
+    """
+    if action not in ('post_add', 'post_remove', 'post_clear'): return
+
+    if not reverse: notebooks = PublishedProject.objects.filter(source=instance)
+    elif action == 'post_add': notebooks = PublishedProject.objects.filter(source__in=pk_set)
+    else: notebooks = PublishedProject.objects.filter(source__in=instance._untagged)
+    for notebook in notebooks.select_related('source').prefetch_related('source__tags'):
+        search.index(notebook)
+
+
+@receiver(m2m_changed, sender=Project.tags.through)
+def count_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Update the project counters of the tags added to or removed from projects, from either side of the relation
+    """
+    if action == 'post_add': changed, sign = pk_set, 1
+    elif action in ('post_remove', 'post_clear'): changed, sign = instance._untagged, -1
+    else: return
+    if reverse: facets.tagging(instance, changed, sign)
+    else: facets.tagged(instance, changed, sign)
+
+
+@receiver(m2m_changed, sender=Project.tags.through)
+def touch_tagged(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'post_add': changed = pk_set
+    elif action in ('post_remove', 'post_clear'): changed = instance._untagged
+    else: return
+    touch(Project.objects.filter(pk__in=changed) if reverse else Project.objects.filter(pk=instance.pk))
+
+
+@receiver(post_save, sender=ProjectAccess)
+@receiver(post_delete, sender=ProjectAccess)
+def touch_access(sender, instance, **kwargs):
+    touch(Project.objects.filter(pk=instance.project_id))
+
+
+@receiver(post_save, sender=PublishedProject)
+def touch_published(sender, instance, created, **kwargs):
+    if created: touch(Project.objects.filter(pk=instance.source_id))
+
+
+@receiver(post_delete, sender=PublishedProject)
+def touch_unpublished(sender, instance, **kwargs):
+    touch(Project.objects.filter(pk=instance.source_id))
+
+
+@receiver(pre_delete, sender=Tag)
+def touch_tag_projects(sender, instance, **kwargs):
+    touch(Project.objects.filter(tags=instance))
+
+
+def touch(projects):
+    """
+    Mark projects as updated when something rendered with them changes without saving them, so that the ETags of
+    the lists they are in change
+    """
+    projects.update(updated=timezone.now())
+
+
+@receiver(post_save, sender=PublishedProject)
+def count_published(sender, instance, created, **kwargs):
+    if created and instance.source_id: facets.published(instance.source_id, 1)
+
+
+@receiver(post_delete, sender=PublishedProject)
+def count_unpublished(sender, instance, **kwargs):
+    if instance.source_id: facets.published(instance.source_id, -1)  # No tags are left if the project was deleted
+
+
+@receiver(pre_delete, sender=Project)
+def count_deleted(sender, instance, **kwargs):
+    """
+    Deleting a project removes its tags without sending m2m_changed
+    """
+    facets.tagged(instance, list(instance.tags.values_list('pk', flat=True)), -1)
+
+
+@receiver(pre_delete, sender=Tag)
+def remember_tag_notebooks(sender, instance, **kwargs):
+    instance._search_notebooks = list(PublishedProject.objects.filter(source__tags=instance).values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Tag)
+def index_tag_notebooks(sender, instance, **kwargs):
+    """
+    Deleting a tag removes it from its projects without sending m2m_changed
+    """
+    for notebook in PublishedProject.objects.filter(pk__in=instance._search_notebooks) \
+            .select_related('source').prefetch_related('source__tags'):
+        search.index(notebook)
+
+
+@receiver(post_save, sender=PublishedProject)
+@receiver(post_delete, sender=PublishedProject)
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=Project)
+@receiver(post_save, sender=ProjectAccess)
+@receiver(post_delete, sender=ProjectAccess)
+def bump_catalog(sender, **kwargs):
+    """
+    Invalidate the cached catalog responses when anything they render changes
+    """
+    cache.bump()
+
+
+@receiver(m2m_changed, sender=Project.tags.through)
+def bump_catalog_tags(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'): cache.bump()
@@ -0,0 +1,394 @@
+import os
+import sys
+import time
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User, Group
+from django.core.cache import caches
+from django.db import connection
+from django.test import SimpleTestCase
+from requests.exceptions import ChunkedEncodingError
+from django.test.utils import CaptureQueriesContext
+from rest_framework.reverse import reverse
+from rest_framework.test import APITestCase
+
+from portal import facets
+from portal.hub import HubClient, HubError, HubUnavailable
+from portal.progress import ProgressRelay
+from portal.serializers import ProjectSerializer
+from portal.models import Tag, Project, ProjectAccess, PublishedProject, SpawnJob
+
+CATALOG_SIZE = 50  # Notebooks in the synthetic catalog, large enough for a query per row to exceed any budget
+TIME_FACTOR = float(os.environ.get('PORTAL_BUDGET_TIME_FACTOR', 1))  # Scales time budgets for slow machines
+
+# Budget of every endpoint: (name, method, URL name, URL kwargs, data, queries, milliseconds, response bytes).
+# URL kwargs naming a model ('project', 'notebook', ...) are replaced by the pk of a seeded instance.
+BUDGETS = [
+    ('api root', 'get', 'api-root', {}, None, 0, 50, 1024),
+    ('user list', 'get', 'user-list', {}, None, 2, 300, 32 * 1024),
+    ('user detail', 'get', 'user-detail', {'pk': 'user'}, None, 2, 50, 1024),
+    ('group list', 'get', 'group-list', {}, None, 1, 100, 4 * 1024),
+    ('group detail', 'get', 'group-detail', {'pk': 'group'}, None, 1, 50, 1024),
+    ('tag list', 'get', 'tag-list', {}, None, 2, 100, 4 * 1024),
+    ('tag detail', 'get', 'tag-detail', {'pk': 'tag'}, None, 1, 50, 1024),
+    ('tag page', 'get', 'tag-list', {}, {'page_size': 5}, 2, 50, 1024),
+    ('tag facets', 'get', 'tag-facets', {}, None, 1, 50, 2 * 1024),
+    ('tag facets filter', 'get', 'tag-facets', {}, {'image': 'genepattern/notebook'}, 2, 100, 2 * 1024),
+    ('tag create', 'post', 'tag-list', {}, {'label': 'new-tag'}, 3, 100, 1024),
+    ('project list', 'get', 'project-list', {}, None, 4, 500, 64 * 1024),
+    ('project page', 'get', 'project-list', {}, {'page_size': 10}, 4, 100, 16 * 1024),
+    ('project detail', 'get', 'project-detail', {'pk': 'project'}, None, 3, 50, 2 * 1024),
+    ('project update', 'put', 'project-detail', {'pk': 'project'}, {
+        'name': 'Notebook 0', 'image': 'genepattern/notebook', 'path': 'path-0', 'dir_name': 'notebook-0',
+        'tags': ['Tag-0', 'tag-1'] + [f'new-tag-{i}' for i in range(20)]}, 27, 300, 2 * 1024),
+    ('project launch', 'post', 'project-launch', {'pk': 'project'}, None, 4, 100, 2 * 1024),
+    ('access list', 'get', 'projectaccess-list', {}, None, 1, 300, 32 * 1024),
+    ('access detail', 'get', 'projectaccess-detail', {'pk': 'access'}, None, 1, 50, 1024),
+    ('notebook list', 'get', 'publishedproject-list', {}, None, 5, 500, 64 * 1024),
+    ('notebook page', 'get', 'publishedproject-list', {}, {'page_size': 10}, 5, 100, 16 * 1024),
+    ('notebook filter', 'get', 'publishedproject-list', {}, {'tags_any': 'tag-5,tag-9', 'ordering': '-copied'}, 5,
+     300, 32 * 1024),
+    ('notebook search', 'get', 'publishedproject-search', {}, {'q': 'notebook 1'}, 5, 100, 32 * 1024),
+    ('notebook detail', 'get', 'publishedproject-detail', {'pk': 'notebook'}, None, 4, 50, 2 * 1024),
+    ('notebook launch', 'post', 'publishedproject-launch', {'pk': 'notebook'}, None, 6, 100, 2 * 1024),
+    ('notebook cohort', 'post', 'publishedproject-cohort', {'pk': 'notebook'}, {'groups': ['cohort']}, 20, 300,
+     16 * 1024),
+    ('spawn list', 'get', 'spawnjob-list', {}, None, 1, 300, 32 * 1024),
+    ('spawn detail', 'get', 'spawnjob-detail', {'pk': 'spawn'}, None, 1, 50, 1024),
+]
+
+
+@mock.patch('portal.hub.get_client')  # Nothing may talk to a real hub
+class EndpointBudgetTests(APITestCase):
+    """
+    Call every endpoint of the portal API against a synthetic catalog, failing when one makes more queries, takes
+    longer or returns more bytes than its budget. Streaming endpoints (progress) and those serving files from the
+    library service (download) are left out.
+    """
+    results = []
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create(username='admin', is_staff=True, is_superuser=True)
+        cohort = Group.objects.create(name='cohort')
+        tags = [Tag.objects.create(label=f'tag-{i}') for i in range(10)]
+        for i in range(CATALOG_SIZE):
+            user = User.objects.create(username=f'user-{i}')
+            if i % 5 == 0: user.groups.add(cohort)
+            project = Project.objects.create(name=f'Notebook {i}', image='genepattern/notebook', path=f'path-{i}',
+                                             dir_name=f'notebook-{i}', description='A notebook ' * 10)
+            project.tags.add(*tags[:i % len(tags) + 1])
+            ProjectAccess.objects.create(user=user, project=project, owner=True)
+            ProjectAccess.objects.create(user=cls.admin, project=project)
+            PublishedProject.objects.create(name=project.name, image=project.image, source=project, path=project.path,
+                                            authors=user.username)
+            SpawnJob.objects.create(user=user, project=project, server_name=project.dir_name, image=project.image)
+
+        project = Project.objects.first()
+        cls.instances = {'user': cls.admin.pk, 'group': cohort.pk, 'tag': tags[0].pk, 'project': project.pk,
+                         'access': ProjectAccess.objects.first().pk, 'notebook': project.published.pk,
+                         'spawn': SpawnJob.objects.first().pk}
+
+    @classmethod
+    def tearDownClass(cls):
+        super(EndpointBudgetTests, cls).tearDownClass()
+        sys.stderr.write(f'\n{"endpoint":<18}{"queries":>9}{"ms":>9}{"bytes":>9}\n')
+        for name, queries, ms, size in cls.results:
+            sys.stderr.write(f'{name:<18}{queries:>9}{ms:>9.1f}{size:>9}\n')
+
+    def setUp(self):
+        self.client.force_authenticate(self.admin)
+
+    def test_budgets(self, get_client):
+        for name, method, url_name, kwargs, data, max_queries, max_ms, max_size in BUDGETS:
+            with self.subTest(endpoint=name):
+                url = reverse(url_name, kwargs={k: self.instances[v] for k, v in kwargs.items()})
+                start = time.perf_counter()
+                with CaptureQueriesContext(connection) as queries:
+                    response = getattr(self.client, method)(url, data, format='json')
+                ms = (time.perf_counter() - start) * 1000
+                self.results.append((name, len(queries), ms, len(response.content)))
+
+                self.assertLess(response.status_code, 300, f'{name}: {response.status_code} {response.content[:200]}')
+                self.assertLessEqual(len(queries), max_queries, f'{name} made {len(queries)} queries:\n' +
+                                     '\n'.join(q['sql'] for q in queries.captured_queries))
+                self.assertLessEqual(ms, max_ms * TIME_FACTOR, f'{name} took {ms:.0f} ms')
+                self.assertLessEqual(len(response.content), max_size, f'{name} returned {len(response.content)} bytes')
+
+    def test_unchanged_lists_are_not_modified(self, get_client):
+        for url_name in ('tag-list', 'project-list', 'publishedproject-list'):
+            with self.subTest(endpoint=url_name):
+                url = reverse(url_name)
+                etag = self.client.get(url)['ETag']
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(len(queries), 1, 'Only the version of the list should be queried')
+
+                Project.objects.first().tags.add(Tag.objects.create(label='changed'))  # Rendered by all three lists
+                self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+                Tag.objects.get(label='changed').delete()
+
+    def test_anonymous_catalog_reads_are_cached(self, get_client):
+        caches['default'].clear()
+        anonymous = self.client_class()
+        for url_name in ('tag-list', 'tag-facets', 'publishedproject-list'):
+            with self.subTest(endpoint=url_name):
+                url = reverse(url_name)
+                content = anonymous.get(url).content
+                with CaptureQueriesContext(connection) as queries:
+                    self.assertEqual(anonymous.get(url).content, content)
+                self.assertEqual(len(queries), 1, 'Only the catalog generation should be queried')
+
+                Project.objects.first().tags.add(Tag.objects.create(label='changed'))  # Rendered by all three
+                self.assertNotEqual(anonymous.get(url).content, content)
+                Tag.objects.get(label='changed').delete()
+
+    def test_anonymous_html_is_not_cached(self, get_client):
+        caches['default'].clear()
+        url = reverse('publishedproject-list')
+        self.client_class().get(url, HTTP_ACCEPT='text/html')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client_class().get(url, HTTP_ACCEPT='text/html')
+        self.assertGreater(len(queries), 1, 'The browsable API page should be rendered for every visitor')
+        self.assertIn(settings.CSRF_COOKIE_NAME, response.cookies, 'Every visitor should get their own CSRF token')
+
+    def test_every_endpoint_has_a_budget(self, get_client):
+        from portal.urls import router
+        budgeted = {budget[2] for budget in BUDGETS}
+        for prefix, viewset, basename in router.registry:
+            if not viewset.__module__.startswith('portal.'): continue  # The project registers other apps' viewsets too
+            for route in ('list', 'detail'):
+                self.assertIn(f'{basename}-{route}', budgeted, f'No budget for the {prefix} {route} endpoint')
+
+
+@mock.patch('portal.hub.get_client')
+class PublishedProjectActionTests(APITestCase):
+    """
+    Requests the notebook actions must reject before anything is submitted to the hub
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create(username='admin', is_staff=True, is_superuser=True)
+        project = Project.objects.create(name='Orphan', image='genepattern/notebook', path='orphan', dir_name='orphan')
+        cls.orphan = PublishedProject.objects.create(name=project.name, image=project.image, source=project,
+                                                     path=project.path)
+
+    def setUp(self):
+        self.client.force_authenticate(self.admin)
+
+    def test_launch_without_owner(self, get_client):
+        response = self.client.post(reverse('publishedproject-launch', kwargs={'pk': self.orphan.pk}))
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(SpawnJob.objects.exists())
+
+    def test_cohort_without_owner(self, get_client):
+        response = self.client.post(reverse('publishedproject-cohort', kwargs={'pk': self.orphan.pk}),
+                                    {'users': ['admin']}, format='json')
+        self.assertEqual(response.status_code, 404)
+
+    def test_download_waits_for_archive(self, get_client):
+        ProjectAccess.objects.create(user=self.admin, project=self.orphan.source, owner=True)
+        get_client.return_value.export_project.return_value = None  # Still being written
+        response = self.client.get(reverse('publishedproject-download', kwargs={'pk': self.orphan.pk}))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response['Retry-After'], str(getattr(settings, 'EXPORT_RETRY_AFTER', 5)))
+
+    def test_cohort_rejects_invalid_input(self, get_client):
+        ProjectAccess.objects.create(user=self.admin, project=self.orphan.source, owner=True)
+        url = reverse('publishedproject-cohort', kwargs={'pk': self.orphan.pk})
+        for data in ({'users': 'admin'}, {'groups': 'cohort'}, {'users': ['admin'], 'concurrency': 'abc'},
+                     {'users': ['admin'], 'concurrency': [5]}, {'users': ['admin'], 'concurrency': 0}, {},
+                     {'users': [], 'groups': []}, {'users': ['nobody'], 'groups': ['nowhere']}):
+            with self.subTest(data=data):
+                self.assertEqual(self.client.post(url, data, format='json').status_code, 400)
+        self.assertFalse(SpawnJob.objects.exists())
+
+
+class NotebookOrderingTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.notebooks = []
+        for i in range(6):
+            project = Project.objects.create(name=f'Notebook {i}', image='genepattern/notebook', path=f'path-{i}',
+                                             dir_name=f'notebook-{i}')
+            cls.notebooks.append(PublishedProject.objects.create(name=project.name, image=project.image,
+                                                                 source=project, path=project.path, copied=i % 2))
+
+    def ids(self, response):
+        return [int(result['url'].rstrip('/').rsplit('/', 1)[1]) for result in response.data['results']]
+
+    def test_ties_are_broken_by_id(self):
+        response = self.client.get(reverse('publishedproject-list'), {'ordering': '-copied'})
+        ids = [int(result['url'].rstrip('/').rsplit('/', 1)[1]) for result in response.data]
+        expected = sorted(self.notebooks, key=lambda notebook: (-notebook.copied, -notebook.pk))
+        self.assertEqual(ids, [notebook.pk for notebook in expected])
+
+    def test_pages_refuse_counts(self):
+        response = self.client.get(reverse('publishedproject-list'), {'ordering': '-copied', 'page_size': 2})
+        self.assertEqual(response.status_code, 400)
+
+    def test_pages_by_timestamp(self):
+        ids, url, params = [], reverse('publishedproject-list'), {'ordering': 'published', 'page_size': 2}
+        while url:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            ids += self.ids(response)
+            url, params = response.data['next'], None
+        self.assertEqual(ids, [notebook.pk for notebook in self.notebooks])
+
+
+class FacetCounterTests(APITestCase):
+    """
+    The counters portal.signals keeps on the tags match an aggregation of the catalog after every kind of change
+    """
+
+    def assertCounted(self, change):
+        expected = {label: count for label, count in facets.counts(Project.objects.all()).items() if any(count)}
+        counted = {tag.label: (tag.published_count, tag.private_count) for tag in Tag.objects.all()
+                   if tag.published_count or tag.private_count}
+        self.assertEqual(counted, expected, f'Counters are wrong after {change}')
+
+    def test_counters_follow_every_change(self):
+        a, b, c = (Tag.objects.create(label=label) for label in 'abc')
+        p1, p2, p3 = (Project.objects.create(name=name, image='genepattern/notebook', path=name, dir_name=name)
+                      for name in ('p1', 'p2', 'p3'))
+
+        p1.tags.add(a, b)
+        p2.tags.add(a)
+        self.assertCounted('adding tags to projects')
+        c.projects.add(p1, p2, p3)
+        self.assertCounted('adding projects to a tag')
+
+        published = PublishedProject.objects.create(name='p1', image=p1.image, source=p1, path=p1.path)
+        self.assertCounted('publishing')
+        published.save()
+        self.assertCounted('updating a published project')
+
+        p1.tags.remove(b, Tag.objects.create(label='unused'))
+        self.assertCounted('removing tags from a project, one of them never added')
+        a.projects.remove(p2)
+        self.assertCounted('removing projects from a tag')
+        p2.tags.clear()
+        self.assertCounted('clearing the tags of a project')
+        c.projects.clear()
+        self.assertCounted('clearing the projects of a tag')
+        p1.tags.set([a, b, c])
+        p3.tags.set([b, c])
+        self.assertCounted('setting tags')
+
+        published.delete()
+        self.assertCounted('unpublishing')
+        PublishedProject.objects.create(name='p1', image=p1.image, source=p1, path=p1.path)
+        self.assertCounted('publishing again')
+
+        p1.delete()
+        self.assertCounted('deleting a published project')
+        p3.delete()
+        self.assertCounted('deleting a private project')
+        p2.tags.add(a, b)
+        b.delete()
+        self.assertCounted('deleting a tag')
+
+
+class ProjectSerializerTests(APITestCase):
+    def test_invalid_project_creates_no_tags(self):
+        serializer = ProjectSerializer(data={'image': 'genepattern/notebook', 'path': 'p', 'dir_name': 'p',
+                                             'tags': ['Brand-New']})  # No name
+        self.assertFalse(serializer.is_valid())
+        self.assertFalse(Tag.objects.filter(label='brand-new').exists())
+
+    def test_tags_are_created_on_save(self):
+        serializer = ProjectSerializer(data={'name': 'P', 'image': 'genepattern/notebook', 'path': 'p',
+                                             'dir_name': 'p', 'tags': ['Brand-New', 'brand-new ', 'other']})
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        project = serializer.save()
+        self.assertEqual(sorted(tag.label for tag in project.tags.all()), ['brand-new', 'other'])
+
+
+class LibraryJobTests(SimpleTestCase):
+    """
+    Archive work is submitted without waiting and its job polled, so no connection stays open while it runs
+    """
+
+    def setUp(self):
+        self.hub = HubClient('http://hub', 'token', archive_timeout=60, poll_interval=0)
+        self.session = mock.patch.object(self.hub.session, 'request').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def respond(self, *jobs):
+        self.session.side_effect = [mock.Mock(status_code=202 if i == 0 else 200, json=mock.Mock(return_value=job))
+                                    for i, job in enumerate(jobs)]
+
+    def test_archive_work_is_polled(self):
+        self.respond({'id': 'a1', 'state': 'queued'}, {'id': 'a1', 'state': 'running'}, {'id': 'a1', 'state': 'done'})
+        self.assertTrue(self.hub.unzip_project('u-p', 'u', 'p'))
+
+        urls = [call[0][1] for call in self.session.call_args_list]
+        self.assertEqual(urls, ['http://hub/services/library/?copy=u-p&user=u&server=p&wait=false',
+                                'http://hub/services/library/jobs/a1', 'http://hub/services/library/jobs/a1'])
+        self.assertTrue(all(call[1]['timeout'] == self.hub.timeout for call in self.session.call_args_list))
+
+    def test_export_does_not_wait(self):
+        self.respond({'id': 'a1', 'state': 'queued'})
+        self.assertIsNone(self.hub.export_project('u-p'))
+        self.assertEqual(self.session.call_count, 1)
+
+    def test_failed_job_raises(self):
+        self.respond({'id': 'a1', 'state': 'queued'}, {'id': 'a1', 'state': 'failed', 'error': 'No such directory'})
+        with self.assertRaisesRegex(HubError, 'No such directory'):
+            self.hub.zip_project('u-p', 'u', 'p')
+
+    def test_unfinished_job_times_out(self):
+        self.hub.archive_timeout = 0.01
+        self.session.side_effect = lambda *args, **kwargs: mock.Mock(
+            status_code=200, json=mock.Mock(return_value={'id': 'a1', 'state': 'running'}))
+        with self.assertRaises(HubUnavailable):
+            self.hub.unzip_project('u-p', 'u', 'p')
+
+
+@mock.patch('portal.progress.latest_spawn', return_value=None)
+@mock.patch('portal.progress.get_client')
+class ProgressRelayTests(SimpleTestCase):
+    """
+    Every relayed stream ends with the hub's ready or failed event, or a failed event of its own
+    """
+
+    def relay(self):
+        relay = ProgressRelay(('user', 'server'), 'user', 'server')
+        relay.thread.join(5)
+        return relay.events
+
+    @mock.patch('portal.progress.time.sleep')
+    def test_waits_for_queued_spawn(self, sleep, get_client, latest_spawn):
+        latest_spawn.side_effect = [SpawnJob(state=SpawnJob.QUEUED), SpawnJob(state=SpawnJob.STAGING),
+                                    SpawnJob(state=SpawnJob.SPAWNING)]
+        get_client.return_value.progress.return_value = iter([{'progress': 100, 'ready': True}])
+        events = self.relay()
+        self.assertEqual(latest_spawn.call_count, 3)
+        self.assertEqual(len(events), 2)
+        self.assertTrue(events[-1]['ready'])
+
+    def test_failed_spawn_fails(self, get_client, latest_spawn):
+        latest_spawn.return_value = SpawnJob(state=SpawnJob.FAILED, message='No such image')
+        events = self.relay()
+        self.assertEqual(events, [{'progress': 100, 'failed': True, 'message': 'No such image'}])
+        get_client.return_value.progress.assert_not_called()
+
+    def test_broken_stream_fails(self, get_client, latest_spawn):
+        def progress(user, server_name):
+            yield {'progress': 10, 'message': 'Pulling image'}
+            raise ChunkedEncodingError('Connection broken')
+        get_client.return_value.progress.side_effect = progress
+        events = self.relay()
+        self.assertEqual(events[0]['progress'], 10)
+        self.assertTrue(events[-1]['failed'])
+
+    def test_invalid_event_fails(self, get_client, latest_spawn):
+        def progress(user, server_name):
+            raise ValueError('Expecting value')
+            yield
+        get_client.return_value.progress.side_effect = progress
+        self.assertTrue(self.relay()[-1]['failed'])
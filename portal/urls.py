@@ -1,6 +1,7 @@
 from rest_framework import routers
 
-from portal.views import UserViewSet, GroupViewSet, ProjectViewSet, PublishedProjectViewSet, ProjectAccessViewSet, TagViewSet
+from portal.views import UserViewSet, GroupViewSet, ProjectViewSet, PublishedProjectViewSet, ProjectAccessViewSet, TagViewSet, \
+    SpawnJobViewSet
 
 router = routers.DefaultRouter()
 
@@ -10,3 +11,4 @@ router.register(r'tags', TagViewSet)
 router.register(r'projects', ProjectViewSet)
 router.register(r'access', ProjectAccessViewSet)
 router.register(r'notebooks', PublishedProjectViewSet)
+router.register(r'spawns', SpawnJobViewSet)
@@ -1,9 +1,13 @@
 from urllib.parse import urlparse
 
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, Group
+from django.db import IntegrityError, transaction
+from django.db.models import Q
 from django.urls import resolve
 from rest_framework.permissions import BasePermission, SAFE_METHODS
 
+from portal.cache import bump
+from portal.hub import encode_name
 from portal.models import Tag, ProjectAccess
 
 
@@ -20,14 +24,33 @@ class IsOwnerOrReadOnly(BasePermission):
         )
 
 
+def normalize_tags(tag_list):
+    """
+    Lowercase and strip tag labels, dropping blanks and duplicates but keeping their order
+    """
+    labels = (str(label).strip().lower() for label in tag_list or [])
+    return list(dict.fromkeys(label for label in labels if label))
+
+
 def create_tags(tag_list):
-    if tag_list is None or len(tag_list) == 0: return;
-    for label in tag_list:
-        label = label.lower()
+    """
+    Resolve tag labels to tags, creating the missing ones, in a constant number of queries
+    :return: list of tags in the order of their normalized labels
+    """
+    labels = normalize_tags(tag_list)
+    if not labels: return []
+    tags = Tag.objects.in_bulk(labels)
+    missing = [Tag(label=label, protected=False, pinned=False) for label in labels if label not in tags]
+    if missing:
         try:
-            Tag.objects.get(label=label)
-        except Tag.DoesNotExist:
-            Tag(label=label, protected=False, pinned=False).save()
+            with transaction.atomic():
+                Tag.objects.bulk_create(missing)
+        except IntegrityError:  # Another request created some of them first
+            for tag in missing:
+                Tag.objects.get_or_create(label=tag.label)
+        tags.update(Tag.objects.in_bulk([tag.label for tag in missing]))  # Loaded, so they can be assigned
+        bump()  # bulk_create sends no post_save
+    return [tags[label] for label in labels]
 
 
 def create_access(username, project, owner=True):
@@ -42,6 +65,28 @@ def model_from_url(cls, url):
     return cls.objects.get(pk=resolved_kwargs['pk'])
 
 
+def archive_id(published):
+    """
+    Return the name of the archive the library service wrote when the project was published by its owner
+    """
+    if published.source is None: return None
+    owner = published.source.access.filter(owner=True).select_related('user').first()
+    if owner is None: return None
+    return f"{owner.user}-{encode_name(published.source.dir_name)}"
+
+
+def resolve_cohort(usernames, group_names):
+    """
+    Return the distinct users named directly or through their groups, plus any names that matched nothing
+    """
+    users = User.objects.filter(Q(username__in=usernames) | Q(groups__name__in=group_names)).distinct()
+    found_users = set(users.values_list('username', flat=True))
+    found_groups = set(Group.objects.filter(name__in=group_names).values_list('name', flat=True))
+    unknown = [name for name in usernames if name not in found_users] + \
+              [name for name in group_names if name not in found_groups]
+    return list(users), unknown
+
+
 def get_copy_path(data):
     # TODO: Implement
     return True
\ No newline at end of file
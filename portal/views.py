@@ -1,20 +1,38 @@
+import os
+
+from django.conf import settings
 from django.contrib.auth.models import User, Group
+from django.db.models import Q
+from django.http import Http404
+from django.utils.text import slugify
+from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.reverse import reverse
+from rest_framework.utils.urls import replace_query_param
 
-from portal.hub import spawn_server, delete_server, stop_server, encode_name, zip_project, unzip_project
-from portal.models import Project, ProjectAccess, PublishedProject, Tag
+from library.delivery import send_file
+from portal import facets, search
+from portal.cache import anonymous_cache
+from portal.conditional import ConditionalListMixin
+from portal.filters import ProjectFilter, PublishedProjectFilter, CursorOrderingFilter
+from portal.hub import delete_server, stop_server, encode_name, zip_project, export_project, HubNotFound
+from portal.jobs import submit_spawn, submit_batch
+from portal.models import Project, ProjectAccess, PublishedProject, Tag, SpawnJob
+from portal.pagination import NotebookPagination, ProjectPagination, TagPagination
+from portal.progress import EventStreamRenderer, progress_response
 from portal.serializers import UserSerializer, GroupSerializer, ProjectSerializer, ProjectAccessSerializer, \
-    PublishedProjectSerializer, TagSerializer, PublishedProjectGetSerializer, ProjectGetSerializer
-from portal.utils import create_tags, create_access, model_from_url, get_copy_path
+    PublishedProjectSerializer, TagSerializer, PublishedProjectGetSerializer, ProjectGetSerializer, SpawnJobSerializer, \
+    CohortSerializer
+from portal.utils import create_access, model_from_url, get_copy_path, archive_id, resolve_cohort
 
 
 class UserViewSet(viewsets.ModelViewSet):
     """
     API endpoint that allows users to be viewed or edited.
     """
-    queryset = User.objects.all().order_by('-date_joined')
+    queryset = User.objects.prefetch_related('groups').order_by('-date_joined')
     serializer_class = UserSerializer
     permission_classes = (permissions.IsAdminUser,)
 
@@ -28,45 +46,79 @@ class GroupViewSet(viewsets.ModelViewSet):
     permission_classes = (permissions.IsAdminUser,)
 
 
-class TagViewSet(viewsets.ModelViewSet):
+class TagViewSet(ConditionalListMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows projects to be viewed or edited.
     """
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
+    pagination_class = TagPagination
+
+    @anonymous_cache
+    def list(self, request, *args, **kwargs):
+        return super(TagViewSet, self).list(request, *args, **kwargs)
+
+    @anonymous_cache
+    def retrieve(self, request, *args, **kwargs):
+        return super(TagViewSet, self).retrieve(request, *args, **kwargs)
+
+    @action(detail=False, methods=['get'])
+    @anonymous_cache
+    def facets(self, request):
+        """
+        Count the published and private projects using each tag, pinned tags first. Counts of the whole catalog are
+        read from the counters kept on the tags. Given any project filter (image, tags, ...), the filtered projects
+        are counted instead.
+        """
+        filterset = ProjectFilter(request.query_params, queryset=Project.objects.all(), request=request)
+        if any(name in request.query_params for name in filterset.filters):
+            if not filterset.is_valid(): return Response(filterset.errors, status=status.HTTP_400_BAD_REQUEST)
+            counts = facets.counts(filterset.qs)
+        else: counts = None
 
+        results = []
+        for tag in self.get_queryset().order_by('-pinned', 'label'):
+            published, private = (tag.published_count, tag.private_count) if counts is None \
+                else counts.get(tag.label, (0, 0))
+            if published or private:
+                results.append({'label': tag.label, 'pinned': tag.pinned, 'protected': tag.protected,
+                                'published': published, 'private': private})
+        return Response(results)
 
-class ProjectViewSet(viewsets.ModelViewSet):
+
+class ProjectViewSet(ConditionalListMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows projects to be viewed or edited.
     """
-    queryset = Project.objects.all()
+    # Load the relations ProjectGetSerializer renders in a fixed number of queries, however many projects there are
+    queryset = Project.objects.select_related('published').prefetch_related('tags', 'access')
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
+    pagination_class = ProjectPagination
+    filter_backends = (DjangoFilterBackend,)
+    filterset_class = ProjectFilter
 
     def get_serializer_class(self):
         if self.request.method == 'GET': return ProjectGetSerializer
         else: return ProjectSerializer
 
-    def list(self, request, *args, **kwargs):
-        if request.user.is_staff: queryset = Project.objects.all()
-        else: queryset = Project.objects.filter(access__user=request.user)
-
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+    def get_queryset(self):
+        queryset = super(ProjectViewSet, self).get_queryset()
+        if self.action == 'list' and not self.request.user.is_staff:
+            queryset = queryset.filter(access__user=self.request.user)  # Users list the projects they can access
+        return queryset
 
     def create(self, request, *args, **kwargs):
         dir_name = encode_name(request.data['name'])  # Set the name of the directory to mount
-        create_tags(request.data['tags'])             # Lazily create tags for the notebook
-        spawn_server(user=request.user, server_name=dir_name, image=request.data['image'])
         response = super(ProjectViewSet, self).create(request, *args, dir_name=dir_name, **kwargs)  # Create the model
         instance = model_from_url(Project, response.data['url'])
         create_access(request.user, instance)  # Grant the user access to the project
+        job = submit_spawn(user=request.user, server_name=dir_name, image=instance.image, project=instance)
+        response.data['spawn'] = spawn_job_url(job, request)  # Poll this URL to know when the server is ready
         return response
 
     def update(self, request, *args, **kwargs):
         instance = self.get_object()
-        create_tags(request.data['tags'])  # Lazily create tags for the notebook
         stop_server(user=request.user, server_name=instance.dir_name)
         return super(ProjectViewSet, self).update(request, *args, **kwargs)
 
@@ -78,25 +130,47 @@ class ProjectViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['post'])
     def launch(self, request, pk=None):
         instance = self.get_object()
-        spawn_server(user=request.user, server_name=instance.dir_name, image=instance.image)
-        return Response(data=None, status=status.HTTP_204_NO_CONTENT)
+        job = submit_spawn(user=request.user, server_name=instance.dir_name, image=instance.image, project=instance)
+        return spawn_job_response(job, request)
+
+    @action(detail=True, methods=['get'], renderer_classes=(EventStreamRenderer,),
+            permission_classes=(permissions.IsAuthenticated,))
+    def progress(self, request, pk=None):
+        instance = self.get_object()
+        return progress_response(user=request.user, server_name=instance.dir_name)
 
 
 class ProjectAccessViewSet(viewsets.ModelViewSet):
     """
     API endpoint that allows project access objects to be viewed or edited.
     """
-    queryset = ProjectAccess.objects.all()
+    queryset = ProjectAccess.objects.select_related('user', 'group')
     serializer_class = ProjectAccessSerializer
     permission_classes = (permissions.IsAdminUser,)
 
 
-class PublishedProjectViewSet(viewsets.ModelViewSet):
+class PublishedProjectViewSet(ConditionalListMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows published projects to be viewed or edited.
     """
-    queryset = PublishedProject.objects.all()
+    # Load the tags and owners of the source project that PublishedProjectGetSerializer renders in a few queries
+    queryset = PublishedProject.objects.select_related('source').prefetch_related('source__tags', 'source__access__user')
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
+    pagination_class = NotebookPagination
+    filter_backends = (DjangoFilterBackend, CursorOrderingFilter)
+    filterset_class = PublishedProjectFilter
+    ordering_fields = ('updated', 'published', 'copied')
+    cursor_ordering_fields = ('updated', 'published')
+    ordering = NotebookPagination.ordering
+    version_fields = ('updated', 'source__updated')  # Tags and owners are rendered from the source project
+
+    @anonymous_cache
+    def list(self, request, *args, **kwargs):
+        return super(PublishedProjectViewSet, self).list(request, *args, **kwargs)
+
+    @anonymous_cache
+    def retrieve(self, request, *args, **kwargs):
+        return super(PublishedProjectViewSet, self).retrieve(request, *args, **kwargs)
 
     def get_serializer_class(self):
         if self.request.method == 'GET': return PublishedProjectGetSerializer
@@ -109,9 +183,120 @@ class PublishedProjectViewSet(viewsets.ModelViewSet):
         zip_project(id=id, user=request.user, server_name=dir_name)
         return super(PublishedProjectViewSet, self).create(request, *args, **kwargs)
 
+    @action(detail=False, methods=['get'])
+    @anonymous_cache
+    def search(self, request):
+        """
+        Search the published notebooks for every word of the q parameter, by name, description, authors and tags.
+        Results are ranked, with the matches in their name and description wrapped in <mark> tags.
+        """
+        try:
+            limit = max(min(int(request.query_params.get('limit', 20)), getattr(settings, 'SEARCH_MAX_RESULTS', 100)), 1)
+            offset = max(int(request.query_params.get('offset', 0)), 0)
+        except ValueError:
+            return Response({'detail': 'limit and offset must be integers.'}, status=status.HTTP_400_BAD_REQUEST)
+        matches = search.search(request.query_params.get('q', ''), limit + 1, offset)
+
+        notebooks = self.get_queryset().in_bulk([id for id, _, _, _ in matches[:limit]])
+        results = []
+        for id, rank, name, description in matches[:limit]:
+            if id not in notebooks: continue  # Deleted since it was found
+            result = self.get_serializer(notebooks[id]).data
+            result.update({'rank': rank, 'highlights': {'name': name, 'description': description}})
+            results.append(result)
+
+        url = request.build_absolute_uri()
+        return Response({'next': replace_query_param(url, 'offset', offset + limit) if len(matches) > limit else None,
+                         'results': results})
+
     @action(detail=True, methods=['post'])
     def launch(self, request, pk=None):
         instance = self.get_object()
-        unzip_project(copy='tabor-Crown', user=request.user, server_name=instance.source.dir_name)
-        spawn_server(user=request.user, server_name=instance.source.dir_name, image=instance.image)
-        return Response(data=None, status=status.HTTP_204_NO_CONTENT)
\ No newline at end of file
+        id = archive_id(instance)
+        if id is None: raise Http404  # No owner, so no archive to copy
+        job = submit_spawn(user=request.user, server_name=instance.source.dir_name, image=instance.image, copy=id)
+        return spawn_job_response(job, request)
+
+    @action(detail=True, methods=['post'], permission_classes=(permissions.IsAuthenticated,))
+    def cohort(self, request, pk=None):
+        """
+        Copy and launch this notebook for every listed user and every member of the listed groups
+        """
+        instance = self.get_object()
+        id = archive_id(instance)
+        if id is None: raise Http404  # No owner, so no archive to copy
+        if not request.user.is_staff and not instance.source.access.filter(user=request.user, owner=True).exists():
+            return Response({'detail': 'Only staff or the owner may launch a notebook for a cohort.'},
+                            status=status.HTTP_403_FORBIDDEN)
+
+        cohort = CohortSerializer(data=request.data)
+        cohort.is_valid(raise_exception=True)
+        users, unknown = resolve_cohort(cohort.validated_data['users'], cohort.validated_data['groups'])
+        if not users: return Response({'detail': 'None of the users or groups exist.', 'unknown': unknown},
+                                       status=status.HTTP_400_BAD_REQUEST)
+        concurrency = min(cohort.validated_data.get('concurrency', getattr(settings, 'COHORT_CONCURRENCY', 10)),
+                          getattr(settings, 'COHORT_MAX_CONCURRENCY', 50))
+        batch, jobs = submit_batch(users, server_name=instance.source.dir_name, image=instance.image, copy=id,
+                                   requested_by=request.user, concurrency=concurrency)
+
+        return Response({
+            'batch': batch,
+            'url': reverse('spawnjob-list', request=request) + f'?batch={batch}',
+            'concurrency': concurrency,
+            'jobs': SpawnJobSerializer(jobs, many=True, context={'request': request}).data,
+            'unknown': unknown,
+        }, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=True, methods=['get'], renderer_classes=(EventStreamRenderer,),
+            permission_classes=(permissions.IsAuthenticated,))
+    def progress(self, request, pk=None):
+        instance = self.get_object()
+        return progress_response(user=request.user, server_name=instance.source.dir_name)
+
+    @action(detail=True, methods=['get'])
+    def download(self, request, pk=None):
+        """
+        Download the published notebook project as a zip archive. The first download of a version answers 202
+        Accepted with Retry-After while the library service writes the archive, ask again until it is sent.
+        """
+        instance = self.get_object()
+        id = archive_id(instance)
+        if id is None: raise Http404
+        try:
+            path = export_project(id)
+        except HubNotFound:
+            raise Http404
+        if path is None:
+            return Response({'detail': 'The archive is being prepared, try again shortly.'},
+                            status=status.HTTP_202_ACCEPTED,
+                            headers={'Location': request.build_absolute_uri(),
+                                     'Retry-After': str(getattr(settings, 'EXPORT_RETRY_AFTER', 5))})
+        return send_file(request, os.path.join(getattr(settings, 'REPOSITORY_DIR', '/data/repository'), path),
+                         'application/zip', filename=f'{slugify(instance.name) or "notebook"}.zip')
+
+
+class SpawnJobViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    API endpoint that allows the progress of server launches to be viewed.
+    """
+    queryset = SpawnJob.objects.all()
+    serializer_class = SpawnJobSerializer
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get_queryset(self):
+        queryset = SpawnJob.objects.select_related('user').order_by('-created')
+        if 'batch' in self.request.query_params: queryset = queryset.filter(batch=self.request.query_params['batch'])
+        if self.request.user.is_staff: return queryset
+        else: return queryset.filter(Q(user=self.request.user) | Q(requested_by=self.request.user))
+
+
+def spawn_job_url(job, request):
+    return reverse('spawnjob-detail', kwargs={'pk': job.pk}, request=request)
+
+
+def spawn_job_response(job, request):
+    """
+    Respond 202 Accepted with the queued spawn job, which clients poll until its state is ready or failed
+    """
+    serializer = SpawnJobSerializer(job, context={'request': request})
+    return Response(serializer.data, status=status.HTTP_202_ACCEPTED, headers={'Location': serializer.data['url']})